@@ -4,6 +4,10 @@ import runclass
 import hrf
 import misc
 import norm
+import glm
+import cache
+import online
+import plan
 import noise
 import mapreduce
 import io
@@ -2,13 +2,13 @@ import os
 from os.path import join, abspath
 import numpy as np
 import itertools
-import h5py
 
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 
 from bigstats.hist import RHist
 from simfMRI.io import read_hdf_inc, get_model_meta, get_model_names
+from simfMRI.io import open_reader
 
 
 def noise_spectrum(noise, name=None):
@@ -40,8 +40,10 @@ def random_timecourses(hdf, model, N, nsim, name=None):
 
     If <name> is not None, the results are saved as a pdf. """
 
-    # Open a handle the hdf file
-    f = h5py.File(hdf,'r')
+    # Use the (pooled) reader session for the 
+    # hdf file, and get the metadata
+    reader = open_reader(hdf)
+    meta = reader.model_meta(model)
 
     # Create (or use) a handle to a multi-page pdf
     if name != None:
@@ -55,17 +57,13 @@ def random_timecourses(hdf, model, N, nsim, name=None):
     # adding them to the same pdf.
     selected = np.random.randint(0, nsim, N)
     for sel in selected:
-        
-        # Get metadata
-        meta =  get_model_meta(hdf, model)
-        
         # Create a figure window
         fig = plt.figure()
         ax = fig.add_subplot(111)
         
         # Get the data
-        dm = f[os.path.join("/", str(sel), model, "dm")].value
-        bold = f[os.path.join("/", str(sel), model, "bold")].value
+        dm = reader.sim(sel, os.path.join(model, "dm"))
+        bold = reader.sim(sel, os.path.join(model, "bold"))
         
         # PLot it
         ax.plot(dm)
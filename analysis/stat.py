@@ -2,50 +2,137 @@ import csv
 import itertools
 import numpy as np
 import bigstats as bs
-from simfMRI.io import read_hdf, get_model_meta, get_model_names
+from simfMRI.io import get_model_names, open_reader
 from bigstats.hist import RHist
 
 
+def load(hdf, model, stat):
+    """ Load <stat> for <model> from <hdf> as an (nsim x ncol) array. 
+    Returns the names of the columns and the array.
+    
+    If <stat> has only one entry (as is the case for 'aic') there is one 
+    column, named <stat>.  If however <stat> has n entries per model 
+    (like 't') there are n-1 columns, named using the design matrix 
+    metadata.  As n matches the number of columns in the design matrix, 
+    the rightmost will always correspond to the dummy predictor and is 
+    therefore discarded. """
+
+    reader = open_reader(hdf)
+    data = np.asarray(reader.column('/' + model + '/' + stat), dtype=float)
+
+    if data.ndim == 1:
+        return [stat, ], data.reshape(-1, 1)
+    
+    data = data[:,0:-1]
+    names = reader.model_meta(model)['dm'][0:data.shape[1]]
+
+    return names, data
+
+
+def _histogram(col, decimals=2):
+    """ Histogram <col> using bins 10 ** -<decimals> wide, returning only 
+    the bins that were hit (as integers, bin ii is centered on ii * 10 ** 
+    -<decimals>) and their counts.  Non-finite values are skipped. 
+    
+    As the histogram is sparse its size depends on the number of values,
+    not on their range. """
+
+    col = col[np.isfinite(col)]
+    
+    return np.unique(np.round(col * (10 ** decimals)), return_counts=True)
+
+
+def _overlaps(names, data, decimals=2):
+    """ Return a dict, keyed by "<name>_<name>", of the pairwise overlap 
+    of the histograms (see _histogram()) of the columns of <data> (nsim x
+    ncol).  The overlap of a pair is the sum of their shared (minimum) 
+    density. """
+
+    hists = []
+    for col in data.T:
+        bins, counts = _histogram(col, decimals)
+        hists.append((bins, counts / float(max(counts.sum(), 1))))
+
+    overlaps = {}
+    for ii, jj in itertools.combinations(range(len(names)), 2):
+        (bins_ii, density_ii), (bins_jj, density_jj) = hists[ii], hists[jj]
+        _, index_ii, index_jj = np.intersect1d(bins_ii, bins_jj, 
+                assume_unique=True, return_indices=True)
+        overlaps[names[ii] + "_" + names[jj]] = np.minimum(
+                density_ii[index_ii], density_jj[index_jj]).sum()
+
+    return overlaps
+
+
+def _summarize(names, data, criterion=None):
+    """ Summarize each column of <data> (nsim x ncol), returning a dict,
+    keyed by <names>, of dicts of statistics (mean, n, std, se and median, 
+    and the area above <criterion>, if it's not None). """
+
+    finite = np.isfinite(data)
+    n = finite.sum(0)
+    
+    mean = np.nanmean(data, 0)
+    std = np.nanstd(data, 0, ddof=1)
+    median = np.nanmedian(data, 0)
+    se = std / np.sqrt(n)
+
+    summaries = {}
+    for ii, name in enumerate(names):
+        summaries[name] = {
+            "mean":mean[ii], 
+            "n":n[ii], 
+            "std":std[ii], 
+            "se":se[ii], 
+            "median":median[ii]}
+
+    if criterion is not None:
+        above = (np.where(finite, data, -np.inf) > criterion).sum(0) / (
+                n.astype(float))
+        for ii, name in enumerate(names):
+            summaries[name]["above"] = above[ii]
+
+    return summaries
+
+
+def summarize(hdf, stat="t", criterion=None, models=None, decimals=2, 
+        overlaps=True):
+    """ Summarize <stat> for every model (or just those in <models>) in 
+    <hdf>, in a single call.  
+    
+    Returns a dict keyed by model of dicts, keyed by column name, of the 
+    mean, n, std, se, median (and area above <criterion>, if not None).  
+    If <overlaps> is True, each model's pairwise histogram overlaps (see 
+    pairwise_overlaps()) are under "overlaps". """
+
+    if models is None:
+        models = get_model_names(hdf)
+
+    summaries = {}
+    for model in models:
+        names, data = load(hdf, model, stat)
+        summaries[model] = _summarize(names, data, criterion)
+        if overlaps:
+            summaries[model]["overlaps"] = _overlaps(names, data, decimals)
+
+    return summaries
+
+
 def create_hist_list(hdf, model, stat):
     """ Create a list of Rhist (histogram) objects for <model> and 
     <stat> in the given <hdf>. 
     
     If <stat> has only one entry (as is the case for 'aic') the list will have 
     only one entry.  If however <stat> has n entries per model (like't') 
-    the list will have n-1 entries. As n matches the number of columns in
-    the design matrix, the rightmost will always correspond to the dummy 
-    predictor and is therefore discarded. """
+    the list will have n-1 entries (see load()). """
+    
+    names, data = load(hdf, model, stat)
     
     hist_list = [] ## A list of RHist objects.
-    meta = get_model_meta(hdf, model) ## metadata for naming
-    
-    # A handle on the hdf data
-    hdfdata = read_hdf(hdf, '/' + model + '/' + stat)   
-    
-    # Loop over the nodes, adding the data
-    # for each to a RHist. 
-    for node in hdfdata:
-        # Some data will be list-like
-        # so try to iterate, if that fails
-        # assume the data is a single number
-        try:
-            for ii in range(len(node)-1):
-                # Init entries in hist_list as needed
-                try:
-                    hist_list[ii].add(node[ii])
-                except IndexError:
-                    hist_list.append(RHist(name=meta['dm'][ii], decimals=2))
-                    hist_list[ii].add(node[ii])
-        except TypeError:
-            # Assume a number so hist_list has only one
-            # entry (i.e. 0).
-            #
-            # Init entries in hist_list as needed
-            try:
-                hist_list[0].add(node)
-            except IndexError:
-                hist_list.append(RHist(name=stat, decimals=2))
-                hist_list[0].add(node)
+    for name, col in zip(names, data.T):
+        hist = RHist(name=name, decimals=2)
+        [hist.add(val) for val in col]
+        hist_list.append(hist)
 
     return hist_list
 
@@ -54,21 +141,10 @@ def summary(hdf, model, stat):
     """ For <model> return a very simple statistical summary (as a dict) of
      <stat> from <hdf>. """
 
-    # Create histograms for the stats
-    hist_list = create_hist_list(hdf, model, stat)
-    
-    # Init the summary and add 
-    # stats to it
-    summary = {}
-    for hist in hist_list:
-        summary[hist.name] = {
-            "mean":hist.mean(), 
-            "n":hist.n(),
-            "std":hist.stdev(),
-            "se":hist.se(),
-            "median":hist.median()}
+    names, data = load(hdf, model, stat)
+    summaries = _summarize(names, data)
     
-    return summary
+    return dict((name, summaries[name]) for name in names)
 
 
 def summary_table(hdf, model, stat, name=None):
@@ -77,8 +153,8 @@ def summary_table(hdf, model, stat, name=None):
     
     If <name> is not None, the table is written to a csv file. """
     
-    # Create histograms for the stats
-    hist_list = create_hist_list(hdf, model, stat)
+    names, data = load(hdf, model, stat)
+    summaries = _summarize(names, data)
     
     # Create the summary table,
     # and give it a header.
@@ -87,10 +163,11 @@ def summary_table(hdf, model, stat, name=None):
     summary.append(head)
     
     # Now add the stats.
-    for hist in hist_list:
+    for col in names:
+        stats = summaries[col]
         summary.append(
-            [hist.name, hist.mean(), hist.stdev(),
-            hist.se(), hist.median(), hist.n()]
+            [col, stats["mean"], stats["std"],
+            stats["se"], stats["median"], stats["n"]]
         )
     
     # And write it?
@@ -104,15 +181,14 @@ def summary_table(hdf, model, stat, name=None):
 
 
 def above(hdf, model, stat, criterion, name=None):
-    """ Return the percent area above <criterion> for <stat> from <model>
-    and <hdf>. If name is not None, save the areas to a table. """
+    """ Return the area (as a fraction, 0-1) above <criterion> for <stat> 
+    from <model> and <hdf>. If name is not None, save the areas to a 
+    table. """
     
-    # Create histograms for the stats
-    hist_list = create_hist_list(hdf, model, stat)
+    names, data = load(hdf, model, stat)
+    summaries = _summarize(names, data, criterion)
     
-    areas = {}
-    for hist in hist_list:
-        areas[hist.name] = hist.above(criterion)
+    areas = dict((col, summaries[col]["above"]) for col in names)
     
     # And write it?
     if name != None:
@@ -132,22 +208,12 @@ def pairwise_overlaps(hdf, model, stat, name=None):
     
     If <name> is not None, the overlaps are written out in a csv table. """
     
-    # Create histograms for the stats
-    hist_list = create_hist_list(hdf, model, stat)
+    names, data = load(hdf, model, stat)
     
-    if len(hist_list) == 1:
-         return {hist_list[0].h.name : 0}
+    if len(names) == 1:
+         return {names[0] : 0}
     else:
-        # Find all pairs (as an index into hist_list)
-        combinations = itertools.combinations(range(len(hist_list)), 2)  
-        
-        # and find all pairwise overlaps.
-        pairwisedata = {}
-        for pair in combinations:
-            hist1 = hist_list[pair[0]]
-            hist2 = hist_list[pair[1]]
-            area = hist1.overlap(hist2)
-            pairwisedata[hist1.name+"_"+hist2.name] = area
+        pairwisedata = _overlaps(names, data)
         
         # Write?
         if name != None:
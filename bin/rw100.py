@@ -36,11 +36,6 @@ class RunRW100(Run):
         # --
         # Optional Globals
         self.ncore = 2
-    
-        # ----
-        # Misc
-        self.prngs = None   ## A list of RandomState() instances
-                            ## setup by the go() attr
 
 
 if __name__ == "__main__":
@@ -31,11 +31,6 @@ class RunSimple100(Run):
         # --
         # Optional Globals
         self.ncore = None
-    
-        # ----
-        # Misc
-        self.prngs = None   ## A list of RandomState() instances
-                            ## setup by the go() attr
 
 
 if __name__ == "__main__":
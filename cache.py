@@ -0,0 +1,94 @@
+""" Small caches for reusing expensive intermediates (e.g. design matrices
+and their factorizations) across simulations. """
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+
+class LRUCache():
+    """ A least-recently-used cache holding up to <maxsize> entries.
+    Counts hits and misses as it goes. """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError("maxsize must be 1 or greater.")
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key, default=None):
+        """ Return the entry for <key> (marking it as recently used),
+        or <default> if there is none. """
+
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries[key] = value
+            ## Reinsert, so it is now the
+            ## most recently used.
+        self.hits += 1
+
+        return value
+
+
+    def put(self, key, value):
+        """ Add <value> as <key>, evicting the least recently used
+        entry if full. """
+
+        self._entries.pop(key, None)
+        self._entries[key] = value
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+    def clear(self):
+        """ Drop all entries and reset the counters. """
+
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    def info(self):
+        """ Return a dict of the hit, miss, and size counts. """
+
+        return {
+            "hits":self.hits,
+            "misses":self.misses,
+            "size":len(self._entries),
+            "maxsize":self.maxsize}
+
+
+def make_key(*parts):
+    """ Hash <parts> (arrays, lists, dicts, strings or numbers) into a
+    compact string key. """
+
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, dict):
+            part = sorted(part.items())
+                ## Order is not stable otherwise
+
+        if isinstance(part, np.ndarray):
+            arr = np.ascontiguousarray(part)
+            h.update(str(arr.dtype) + str(arr.shape))
+            h.update(arr.tostring())
+        else:
+            h.update(repr(part))
+
+    return h.hexdigest()
@@ -12,20 +12,24 @@ You might also want to override
     self.hrf_params
 """
 import re
-import ConfigParser
 import numpy as np
 from copy import deepcopy
 from collections import defaultdict
 from functools import partial
-try:
-    from statsmodels.api import GLS
-except ImportError:
-    from scikits.statsmodels.api import GLS
-
 from simfMRI import norm
+from simfMRI import glm
+from simfMRI.cache import make_key
 from simfMRI.noise import white
-from simfMRI.hrf import double_gamma
-from simfMRI.timing import dtime
+from simfMRI.hrf import cached_double_gamma, convolve
+from simfMRI.timing import design
+from simfMRI.plan import ModelPlan
+
+
+STATE_FIELDS = ("TR", "ISI", "trials", "data", "dm", "bold")
+    ## Exp attributes save_state() can keep
+
+STAT_FIELDS = glm.STATS
+    ## Model statistics save_state() can keep
 
 
 class Exp():
@@ -57,7 +61,7 @@ class Exp():
         self.noise_f = white
         self.hrf_params = {"width":32,"TR":1,"a1":6.0,"a2":12.,
                 "b1":0.9,"b2":0.9,"c":0.35}
-        self.hrf = double_gamma(**self.hrf_params)
+        self.hrf = cached_double_gamma(**self.hrf_params)
         # ----
         
         # ----
@@ -72,7 +76,38 @@ class Exp():
         self.bold = None    ## The bold signal (create_bold).
         self.results = {}   ## Simulation results go here.
                             ## After a save_state() call.
-        self.glm = None     ## Where the GLM object is stored after a fit call.
+        self.glm = None     ## Where the GLM results (see simfMRI.glm.fit)
+                            ## are stored after a fit call.
+        self.design = None  ## The factorized design used by the last fit.
+        
+        self.dm_cache = None
+            ## An optional simfMRI.cache.LRUCache() of
+            ## finished designs, shared between Exp
+            ## instances (see Run()).  None disables it.
+
+        self.save_fields = None
+            ## The STATE_FIELDS and STAT_FIELDS that
+            ## save_state() keeps (and "noise", see
+            ## common_noise).  None keeps them all.
+
+        self.plan = None
+            ## The simfMRI.plan.ModelPlan() of models to 
+            ## run(), see populate_models().
+
+        self.common_noise = False
+            ## If True, the noise is drawn once per 
+            ## simulation and added to every model's
+            ## bold (common random numbers), so model 
+            ## differences aren't swamped by noise. It
+            ## is saved once, as results["noise"], and
+            ## every model's bold must be the same length.
+
+        self._memo = {}
+            ## This simulation's intermediates, shared 
+            ## by all its models (see _memoize()).
+        self._dm_source = None
+            ## The (dm, keys) of the last DM made from
+            ## intermediates, see _set_dm().
         # ----
         
         # ----
@@ -112,7 +147,11 @@ class Exp():
 
     def _orth_dm(self):
         """ Orthgonalize (by regression) each col in self.dm with respect to 
-        its left neighbor. """
+        its left neighbor.  
+        
+        As the old (GLS loop) version did, only the last col of each 
+        condition ends up orthgonalized; the loop restored the cols to its 
+        left as it went. """
         
         dm = self.dm  
             ## Rename for brevity
@@ -129,65 +168,38 @@ class Exp():
         # If these are the same size there is nothing to
         # orthgonalize.
         if ncols != nconds:
-            orth_dm = np.zeros_like(dm)
-            orth_dm[:,0] = dm[:,0]
-                ## Move baseline data over
-
             # Use num_col_per_cond, along with nconds 
             # to find the strides we need to take along
             # the DM to orthgonalize each set of col(s) 
-            # belonging to each cond.
-            num_col_per_cond = ncols / nconds
+            # belonging to each cond, pairing the last 
+            # (right) col with its left neighbor.
+            num_col_per_cond = ncols // nconds
+            pairs = []
             for cond in conds:
                 # Skip baseline
                 if cond == 0: 
                     continue
                 
-                left = cond
-                right = cond + nconds
-                
-                # Rolling loop over the cols_per_cond
-                # orthgonalizing as we go.
-                # Note: we never use cnt directly...
-                for cnt in range(num_col_per_cond-1):
-                    # Orthgonalize left col to right....
-                    glm = GLS( dm[:,right], dm[:,left]).fit()  ## GLS(y, x)
-                    orth_dm[:,right] = glm.resid
-                    orth_dm[:,left] = dm[:,left]
-                   
-                    # Shift indices for next iteration.
-                    left = deepcopy(right)
-                    right = right + nconds
-
-            self.dm = orth_dm
+                right = cond + (nconds * (num_col_per_cond - 1))
+                pairs.append((right - nconds, right))
+
+            # Orthgonalize every pair at once.
+            self.dm = glm.orthogonalize(dm, pairs)
         else:
             print("Nothing to orthgonalize.")
     
     
     def _convolve_hrf(self, arr):
         """
-        Convolves hrf basis with a 1 or 2d (column-oriented) array.
+        Convolves hrf basis with a 1 or 2d (column-oriented) array, or
+        a 3d stack (nsim x T x ncol) of them.
         """
         
         # self.hrf may or may not exist yet
-        if self.hrf == None:
+        if self.hrf is None:
             raise ValueError("No hrf is defined. Try self.create_hrf()?")
         
-        arr = np.asarray(arr)   ## Just in case 
-
-        # Assume 2d (or really N > 1 d), 
-        # fall back to 1d.
-        arr_c = np.zeros_like(arr)
-        try:
-            for col in range(arr.shape[1]):
-                arr_c[:,col] = np.convolve(
-                        arr[:,col], self.hrf)[0:arr.shape[0]]
-                    ## Convolve and truncate to length
-                    ## of arr
-        except IndexError:
-            arr_c = np.convolve(arr[:], self.hrf)[0:arr.shape[0]]
-        
-        return arr_c
+        return convolve(arr, self.hrf)
     
     
     def _reformat_model(self):
@@ -197,57 +209,201 @@ class Exp():
         into a dict.
         """
 
-        tosave = {
-            "beta":"params",
-            "t":"tvalues",
-            "fvalue":"fvalue",
-            "p":"pvalues",
-            "r":"rsquared",
-            "ci":"conf_int",
-            "resid":"resid",
-            "aic":"aic",
-            "bic":"bic",
-            "llf":"llf",
-            "mse_model":"mse_model",
-            "mse_resid":"mse_resid",
-            "mse_total":"mse_total"
-        }
-        
-        # Try to get each attr (a value in the dict above)
-        # first as function (without args) then as a regular
-        # attribute.  If both fail, silently move on.
+        # Get each (selected) stat from the current fit, 
+        # silently skipping any that are missing.
+        #
+        # Each fit makes new arrays, so there is no
+        # need to copy them.
         model_results = {}
-        for k,v in tosave.items():
+        if self.glm is None:
+            return model_results
+
+        for k in STAT_FIELDS:
+            if (self.save_fields is not None) and (k not in self.save_fields):
+                continue
             try:
-                model_results[k] = deepcopy(getattr(self.glm,v)())
-            except TypeError:
-                model_results[k] = deepcopy(getattr(self.glm,v))
-            except AttributeError:
+                model_results[k] = self.glm[k]
+            except KeyError:
                 continue
         
         return model_results
     
     
-    def _generate_doc(self, name, bold, dm, dm_params):
-        """ Generate a doc string for the current model. """
-    
-        if dm_params.get("box"):
-            doc =  """ {0}. Bold: {1}. DM: {2}. """.format(
-                    name, bold, ["baseline", "box"] + dm)
+    def _memoize(self, key, make):
+        """ Return this simulation's intermediate <key>, calling <make>()
+        to create it the first time.  
+        
+        Intermediates (DM columns, their convolved and normalized copies, 
+        noiseless bold signals and designs) are shared by every model in 
+        run(), so arrays are made read-only. """
+
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+
+        value = make()
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        self._memo[key] = value
+
+        return value
+
+
+    def _unit(self, drop):
+        """ The unit DM, see simfMRI.timing.design(). """
+
+        return self._memoize(("unit", drop), 
+                lambda: design(self.trials, self.durations, drop=drop))
+
+
+    def _column(self, key):
+        """ Return the DM column named by <key>. 
+        
+        Columns are named by tuples: ("unit", drop, level) for unit DM 
+        columns, ("param", name, drop, block) for parametric columns, 
+        ("orth", keys, ii) for the orthgonalized column ii of <keys>, and 
+        ("conv", key) or ("norm", norm, key) for convolved or normalized 
+        copies of <key> (see _convolved() and _normalized()). 
+        
+        Unit columns count levels (see _levels()) from 0, so the unit DM's
+        baseline is ("unit", None, 0). """
+
+        kind = key[0]
+        if kind == "unit":
+            return self._unit(key[1])[:,key[2]]
+        elif kind == "param":
+            name, drop, block = key[1:]
+            params = self._memoize(("param", name, drop), 
+                    lambda: design(self.trials, self.durations, self.data, 
+                            [name, ], drop, box=False)[:,1:])
+                ## Drop the baseline, leaving a
+                ## column for each condition
+            return params[:,block]
+        elif kind == "orth":
+            keys, ii = key[1:]
+            return self._memoize(("orth", keys), 
+                    lambda: self._orth_matrix(keys))[:,ii]
         else:
-            doc =  """ {0}. Bold: {1}. DM: {2}. """.format(
-                    name, bold, ["baseline", ] + dm)
-                    ## baseline is added automigcally
-                    ## during create_dm... so we add 
-                    ## it here too
-        return doc
+            return self._memo[key]
 
-    
-    def _template_model(self, bold, dm, bold_params, dm_params, norm):
+
+    def _matrix(self, keys):
+        """ Return a (new) DM made from the columns <keys>. """
+
+        return np.column_stack([self._column(key) for key in keys])
+
+
+    def _set_dm(self, keys):
+        """ Make self.dm from the columns <keys>. """
+
+        self.dm = self._matrix(keys)
+        self._dm_source = (self.dm, list(keys))
+
+
+    def _dm_keys(self):
+        """ Return the columns self.dm was made from, or None if it was 
+        not made by _set_dm() (or has since been replaced). """
+
+        if (self._dm_source is None) or (self._dm_source[0] is not self.dm):
+            return None
+
+        return self._dm_source[1]
+
+
+    def _levels(self):
+        """ The (sorted) conditions in self.trials, see 
+        simfMRI.timing.design(). """
+
+        def make():
+            n = min(len(self.trials), len(self.durations))
+            return np.unique(np.asarray(self.trials)[0:n])
+
+        return self._memoize(("levels", ), make)
+
+
+    def _unit_keys(self, drop=None):
+        """ Columns of the unit DM (see create_dm()). """
+        
+        if drop is not None:
+            drop = tuple(drop)
+        
+        return [("unit", drop, ii) for ii in range(len(self._levels()))]
+
+
+    def _param_keys(self, names, drop=None, box=True):
+        """ Columns of the parametric DM (see create_dm_param()). """
+
+        if drop is not None:
+            drop = tuple(drop)
+
+        # Unit DM (or its baseline) on the left,
+        keys = self._unit_keys(None)
+        if not box:
+            keys = keys[0:1]
+        
+        # then a block of names for each condition.
+        nblock = (self._levels() != 0).sum()
+        for block in range(nblock):
+            keys.extend([("param", name, drop, block) for name in names])
+        
+        return keys
+
+
+    def _orth_matrix(self, keys):
+        """ Return the DM made from <keys>, orthgonalized by _orth_dm(). """
+
+        self.dm = self._matrix(keys)
+        self._orth_dm()
+
+        return self.dm
+
+
+    def _orthogonalized(self, keys):
+        """ Orthgonalize the columns <keys> (see _orth_dm()) returning
+        the keys of the result. """
+
+        keys = tuple(keys)
+
+        return [("orth", keys, ii) for ii in range(len(keys))]
+
+
+    def _convolved(self, keys):
+        """ Convolve the columns <keys> with the HRF, returning the keys 
+        of the result.  Only columns not already convolved are. """
+
+        missing = [key for key in keys if ("conv", key) not in self._memo]
+        if missing:
+            conv = self._convolve_hrf(self._matrix(missing))
+            for ii, key in enumerate(missing):
+                self._memoize(("conv", key), lambda: conv[:,ii])
+
+        return [("conv", key) for key in keys]
+
+
+    def _normalized(self, keys, norm):
+        """ Normalize the columns <keys> (using <norm>), returning the keys
+        of the result.  Only columns not already normalized are.
+
+        Note: this assumes, like those in simfMRI.norm, <norm> works on each
+        column independently. """
+
+        missing = [key for key in keys if ("norm", norm, key) not in self._memo]
+        if missing:
+            normed = self._normalize_array(self._matrix(missing), norm)
+            for ii, key in enumerate(missing):
+                self._memoize(("norm", norm, key), lambda: normed[:,ii])
+
+        return [("norm", norm, key) for key in keys]
+
+
+    def _template_model(self, bold, dm, bold_params, dm_params, norm, 
+            stats=None):
         """ A template model used by populate_models() to create all
         the regression models used during a run().
         
-        Note: __doc__ for this function gets redone dynamically. """
+        Note: <bold> and <dm> are shared by every simulation, so they
+        must not be changed here. """
         
         self.data["meta"]["bold"] = deepcopy(bold)
 
@@ -259,37 +415,78 @@ class Exp():
             # otherwise just account for the baseline
             self.data["meta"]["dm"] = ["baseline", ] + dm
         
+        # Reuse a finished design if one is cached.
+        key = self._design_key(dm, dm_params, norm)
+        cached = None
+        if key is not None:
+            cached = self.dm_cache.get(key)
+
         # Try to unpack dm_params into create_dm
         # first, but if there are too many args
         # ("TypeError") try create_dm_param
         if len(dm_params) == 2:
             # Setup the dm,
-            self.create_dm(**dm_params)
+            if cached is None:
+                self.create_dm(**dm_params)
+            else:
+                self.dm = cached["dm"]
             
             # and the univariate bold.
             boldcol = [dm.index(b)+1 for b in bold]  
                 ## +1 for baseline
             
-            self.create_bold(self.dm[:,boldcol], **bold_params)
+            signal = self._memoize(
+                    ("signal", make_key(dm, dm_params, bold, bold_params)),
+                    lambda: self._signal(self.dm[:,boldcol], **bold_params))
         elif len(dm_params) == 4:
 
             # Setup the dm,
-            self.create_dm_param(names=dm, **dm_params)
+            if cached is None:
+                self.create_dm_param(names=dm, **dm_params)
+            else:
+                self.dm = cached["dm"]
             
             # then the parametric bold 
             # from self.data[]
-            boldarr = np.array(self.data[bold.pop()])  ## Init
-
-            # Only goes if len(bold) > 1, see pop above.
-            for b in bold:
-                boldarr = np.vstack((boldarr, np.array(self.data[b])))
-            
-            self.create_bold(boldarr, **bold_params)
+            signal = self._memoize(
+                    ("signal", make_key(bold, bold_params)),
+                    lambda: self._signal(self._data_array(bold), 
+                            **bold_params))
         else:
             raise ValueError(
                 "dm_params has the wrong number of arguments.")
+        
+        self._add_noise(signal)
+
+        if cached is None:
+            self.fit(norm=norm, stats=stats)
+            if key is not None:
+                self.dm.setflags(write=False)
+                    ## Now shared, so protect it
+                self.dm_cache.put(key, {"dm":self.dm, "design":self.design})
+        else:
+            self.fit(norm=norm, design=cached["design"], stats=stats)
+    
+    
+    def _design_key(self, dm, dm_params, norm):
+        """ Return a self.dm_cache key for the design described by <dm>, 
+        <dm_params> and <norm>, or None if there is no cache. 
+        
+        The key covers everything the finished design depends on: trials,
+        durations, the HRF, the model's dm config, normalization and any 
+        named (parametric or movement) data. """
+
+        if self.dm_cache is None:
+            return None
+        
+        named = []
+        if len(dm_params) == 4:
+            named = [np.asarray(self.data[name]) for name in dm]
+        if "movement" in self.data:
+            named.append(np.asarray(self.data["movement"]))
 
-        self.fit(norm=norm)
+        return make_key(np.asarray(self.trials), np.asarray(self.durations), 
+                np.asarray(self.hrf), dm, dm_params, norm, *named)
     
     
     def create_dm(self, drop=None, convolve=True):
@@ -298,30 +495,11 @@ class Exp():
         
          If <convolve> the dm is convolved with the HRF (self.hrf). """
 
-        cond_levels = sorted(list(set(self.trials)))
-            ## Find and sort conditions in trials
-        
-        # Some useful counts...
-        num_conds = len(cond_levels)
-        num_tr = np.sum(self.durations)
-
-        # Map each condition in trials to a
-        # 2d binary 2d array.  Each row is a trial
-        # and each column is a condition.
-        dm_unit = np.zeros((num_tr, num_conds))
-        for col, cond in enumerate(cond_levels):
-            # Create boolean array use it to 
-            # populate the dm with ones... 
-            # which must be in tr time.
-            mask_in_tr = dtime(
-                    self.trials == cond, self.durations, drop, False)
-
-            dm_unit[mask_in_tr,col] = 1
-
-        self.dm = dm_unit
-        
+        keys = self._unit_keys(drop)
         if convolve:
-            self.dm = self._convolve_hrf(self.dm)
+            keys = self._convolved(keys)
+
+        self._set_dm(keys)
 
 
     def create_dm_param(self, names, drop=None, box=True, orth=False, convolve=True):
@@ -335,66 +513,17 @@ class Exp():
         
         If <convolve> the dm is convolved with the HRF (self.hrf). """
 
-        cond_levels = sorted(list(set(self.trials)))
-            ## Find and sort conditions in trials
-       
-        # Some useful counts...
-        num_names = len(names)
-        num_tr = np.sum(self.durations)
-        dm_param = None
-            ## Will eventually hold the 
-            ## parametric DM.
-
-        for cond in cond_levels:
-            if cond == 0:
-                continue
-                    ## We add the baseline 
-                    ## in at the end
-
-            # Create a temp dm to hold this
-            # condition"s data
-            dm_temp = np.zeros((num_tr, num_names))
-            mask_in_tr = dtime(
-                    self.trials == cond, self.durations, drop, False)
-
-            # Get the named data, convert to tr time 
-            # then add to the temp dm using the mask
-            for col, name in enumerate(names):
-                data_in_tr = dtime(
-                            self.data[name], self.durations, drop, 0)
-
-                dm_temp[mask_in_tr,col] = data_in_tr[mask_in_tr]
-                    
-            # Store the temporary DM in 
-            # the final DM.
-            if dm_param == None:
-                dm_param = dm_temp  ## reinit
-            else:
-                dm_param = np.hstack((dm_param, dm_temp))  ## adding
-
-        # Create the unit DM too, then combine them.
-        # defining self.dm in the process
-        self.create_dm(convolve=False)
-        dm_unit = self.dm.copy()
-        self.dm = None  
-            ## Copy and reset
-
-        if box:
-            self.dm = np.hstack((dm_unit, dm_param))
-        else:
-            baseline = dm_unit[:,0]
-            baseline = baseline.reshape(baseline.shape[0], 1)
-            self.dm = np.hstack((baseline, dm_param))
-                ## If not including the boxcar,
-                ## we still need the baseline model.
+        keys = self._param_keys(names, drop, box)
 
         # Orthgonalize the regessors?
         if orth: 
-            self._orth_dm()
+            keys = self._orthogonalized(keys)
 
         # Convolve with self.hrf?
         if convolve: 
-            self.dm = self._convolve_hrf(self.dm)
+            keys = self._convolved(keys)
+
+        self._set_dm(keys)
     
     
     def create_bold(self, arr, convolve=False):
@@ -405,55 +534,106 @@ class Exp():
         self.hrf().
         """
         
+        self._add_noise(self._signal(arr, convolve))
+
+
+    def _signal(self, arr, convolve=False):
+        """ Return the noiseless bold signal for <arr> (see create_bold()). 
+        """
+        
         arr = np.array(arr)
         try:
-            self.bold = arr.sum(1)
+            signal = arr.sum(1)
                 ## Sum cols, arr might 
                 ## have been 2d, need 1d.
         except ValueError:
-            self.bold = arr
+            signal = arr
         
         # HRF?
         if convolve:
-            self.bold = self._convolve_hrf(self.bold)
+            signal = self._convolve_hrf(signal)
         
-        # And add noise.
-        noise, self.prng = self.noise_f(N=self.bold.shape[0], prng=self.prng)
-        self.bold += noise
+        return signal
+
+
+    def _add_noise(self, signal):
+        """ Add noise (from self.noise_f) to <signal>, making self.bold. 
+        
+        If self.common_noise, the noise is drawn only once per simulation,
+        so every <signal> must be the same length. """
+
+        N = signal.shape[0]
+        if not self.common_noise:
+            noise, self.prng = self.noise_f(N=N, prng=self.prng)
+        else:
+            noise = self._memoize("noise", lambda: self._draw_noise(N))
+            if noise.shape[0] != N:
+                raise ValueError(
+                        "With common_noise every bold must be the same"
+                        " length ({0}, not {1}).".format(noise.shape[0], N))
+            
+            if (self.save_fields is None) or ("noise" in self.save_fields):
+                self.results["noise"] = noise
+        
+        self.bold = signal + noise
+
+
+    def _draw_noise(self, N):
+        """ Return <N> samples of noise from self.noise_f. """
+
+        noise, self.prng = self.noise_f(N=N, prng=self.prng)
+
+        return noise
+
+
+    def _data_array(self, names):
+        """ Stack the <names> in self.data into an array, the last name 
+        first. """
+
+        boldarr = np.array(self.data[names[-1]])  ## Init
+
+        # Only goes if len(names) > 1
+        for name in names[:-1]:
+            boldarr = np.vstack((boldarr, np.array(self.data[name])))
+
+        return boldarr
     
     
     def save_state(self, name):
         """
-        Saves most of the state of the current simulation to results, keyed
-        on <name>.  Saves greedily, trading storage space for security and
-        redundancy.
+        Saves the state of the current simulation to results, keyed on 
+        <name>.  By default saves greedily, trading storage space for 
+        security and redundancy; set self.save_fields to save less.
+
+        Nothing is deep copied.  Results hold references to the current dm,
+        bold and fit (which are remade by each model), while trials and data 
+        are shared by all models of the simulation.
         """
         
-        tosave = {
-            "TR":"TR",
-            "ISI":"ISI",
-            "trials":"trials",
-            "data":"data",
-            "dm":"dm",
-            "bold":"bold"
-        }
-            ## This list is only for attr hung directly off
-            ## of self.
+        fields = self.save_fields
         
         # Add a name to results
         self.results[name] = {}
         
-        # Try to get each attr (a value in the dict above)
-        # first as function (without args) then as a regular
-        # attribute.  If both fail, silently move on.
-        for k,v in tosave.items():
+        # Get each (selected) attr, silently skipping
+        # any that are missing.
+        for k in STATE_FIELDS:
+            if (fields is not None) and (k not in fields):
+                continue
             try:
-                self.results[name][k] = deepcopy(getattr(self,v)())
-            except TypeError:
-                self.results[name][k] = deepcopy(getattr(self,v))
+                self.results[name][k] = getattr(self, k)
             except AttributeError:
                 continue
 
+        # Data is shared across models, only meta 
+        # changes between them so only it is copied.  
+        # Meta is always kept, as readers need it.
+        if "data" in self.results[name]:
+            self.results[name]["data"] = dict(self.data)
+        else:
+            self.results[name]["data"] = {}
+        self.results[name]["data"]["meta"] = dict(self.data["meta"])
+
         # Now add the reformatted data from the current model,
         # if any.
         self.results[name].update(self._reformat_model())
@@ -462,58 +642,167 @@ class Exp():
     def populate_models(self, model_config):
         """ Use <model_config> to populate the experiment with models. 
         
+        <model_config> is either a simfMRI.plan.ModelPlan() or the .ini
+        file to compile one from.  Sharing one plan between experiments 
+        saves parsing (and checking) the file for each.
+
         Note:
-        Models become methods that must follow the naming convention,
-        model_XX.., where XX.. is more than two integers [0-9].  
-        
-        For example: model_01, model_010, and model_69 are valid, 
-        while model_A1, model_1 are not. """
-        
-        # Read in the model_config and loop
-        # over its
-        conf = ConfigParser.ConfigParser()
-        readresult = conf.read(model_config)
-            ## If conf.read() can't find model_config
-            ## it (annoyingly) returns an empty list
-            ## in python empty lists are false, so...
-
-        if readresult:
-            print(conf.sections()) 
-                ## Tell the user about the models.
-            
-            for sec in conf.sections():
-                # Get the config data for sec
-                dm_params = eval(conf.get(sec, "dm_params"))
-                bold_params = eval(conf.get(sec, "bold_params"))
-                bold = eval(conf.get(sec, "bold"))
-                dm = eval(conf.get(sec, "dm"))
-                norm = eval(conf.get(sec, "norm"))
-                    ## Note: Using eval is slow and REALLY unsafe
-
-                # Close on _template_model, update its
-                # __doc__ and hang it on self as <sec>.
-                parmodel = partial(self._template_model, bold, dm, 
-                        bold_params, dm_params, norm)
-                parmodel.__doc__ = self._generate_doc(sec, bold, dm, dm_params)
-            
-                print("Created:{0}" .format(parmodel.__doc__))
-                setattr(self, sec, parmodel)
-                    ## setattr magic to add 
-                    ## <parmodel> to self as <sec>
-        else:
-            raise IOError("No such file: '{0}'".format(model_config))
+        Models are named model_XX.., where XX.. is more than two integers 
+        [0-9].  For example: model_01, model_010, and model_69 are valid, 
+        while model_A1, model_1 are not.  Once populated, each can be 
+        called as a method (e.g. self.model_01()).
+        
+        Besides the required norm, bold, dm, dm_params and bold_params, a 
+        section may list the stats (see STAT_FIELDS) its fit should 
+        calculate, for example 'stats = ["t", ]'.  By default all are. """
+        
+        if isinstance(model_config, ModelPlan):
+            self.plan = model_config
+            return
+        
+        self.plan = ModelPlan(model_config)
+        
+        print(self.plan.names) 
+            ## Tell the user about the models.
+        for name in self.plan.names:
+            print("Created:{0}" .format(self.plan.doc(name)))
     
     
-    def fit(self, norm="zscore"):
-        """ Calculate the regression parameters and statistics. """
+    def __getattr__(self, name):
+        """ Models (see populate_models()) are found in self.plan. """
+
+        plan = self.__dict__.get("plan")
+        if (plan is None) or (name not in plan):
+            raise AttributeError(name)
+
+        return partial(self._fit_model, name)
+
+
+    def _fit_model(self, name):
+        """ Fit the model <name> from self.plan. """
+
+        model = self.plan.models[name]
+        if model.get("family") is not None:
+            self._fit_member(name)
+            return
+
+        self._template_model(model["bold"], model["dm"], 
+                model["bold_params"], model["dm_params"], model["norm"], 
+                model["stats"])
+
+
+    def _fit_member(self, name):
+        """ Fit <name>, a member of a model family (see 
+        simfMRI.plan.ModelPlan), by looking up its fit in its family's. """
+
+        model = self.plan.models[name]
+        fitted = self._memoize(("family", model["family"]),
+                lambda: self._fit_family(model["family"]))
         
-        bold = self.bold.copy()
-        dm = self.dm.copy()
+        self.data["meta"]["bold"] = deepcopy(model["bold"])
+        if model["dm_params"].get("box"):
+            self.data["meta"]["dm"] = ["baseline", "box"] + model["dm"]
+        else:
+            self.data["meta"]["dm"] = ["baseline", ] + model["dm"]
+
+        self.bold = fitted["bold"]
+        self.dm = fitted[name]["dm"]
+        self.design = fitted[name]["design"]
+        self.glm = fitted[name]["glm"]
+
+
+    def _fit_family(self, family):
+        """ Fit every member of <family> (see simfMRI.plan.ModelPlan) to 
+        one shared bold, returning a dict of each member's dm, design and 
+        glm (and the "bold").
         
-        # Normalize both the bold and dm
-        if norm != None:
-            bold = self._normalize_array(bold, norm)
-            dm = self._normalize_array(dm, norm)
+        The DM of every member is a subset of the columns of the family's
+        full DM, so rather than factorizing each member's design from 
+        scratch, one QR decomposition is updated from member to member 
+        (see simfMRI.glm.update_designs()). """
+        
+        spec = self.plan.families[family]
+        names = spec["dm"]
+        
+        # The full DM, and the bold.
+        self.create_dm_param(names=names, **spec["dm_params"])
+        full = self.dm
+        
+        signal = self._memoize(
+                ("signal", make_key(spec["bold"], spec["bold_params"])),
+                lambda: self._signal(self._data_array(spec["bold"]), 
+                        **spec["bold_params"]))
+        self._add_noise(signal)
+        
+        # Normalize and truncate, as fit() does.
+        stats = spec["stats"]
+        if (stats is None) and (self.save_fields is not None):
+            stats = [k for k in STAT_FIELDS if k in self.save_fields]
+
+        dm = self._design_matrix(spec["norm"])
+        bold = self.bold.copy()
+        if spec["norm"] != None:
+            bold = self._normalize_array(bold, spec["norm"])
+        bold = bold[0:dm.shape[0]]
+        dm = dm[0:len(bold),:]
+        
+        # Find each member's columns (the unit DM, or 
+        # its baseline, a block of names for each
+        # condition, then the dummy).
+        nunit = len(self._levels()) if spec["dm_params"].get("box") else 1
+        nblock = (self._levels() != 0).sum()
+        columns = []
+        for member, subset in spec["members"]:
+            cols = range(nunit)
+            for block in range(nblock):
+                cols.extend([nunit + (block * len(names)) + names.index(n) 
+                        for n in subset])
+            cols.append(dm.shape[1] - 1)
+            columns.append(cols)
+
+        fitted = {"bold":self.bold}
+        designs = glm.update_designs(dm, columns)
+        for (member, subset), cols, design in zip(
+                spec["members"], columns, designs):
+            fitted[member] = {
+                    "dm":full[:,cols[0:-1]], 
+                    "design":design, 
+                    "glm":glm.fit(bold, design, stats)}
+
+        return fitted
+
+
+    def _model_names(self):
+        """ Return the names of all models, in the order to run them. 
+        
+        Models are those in self.plan (if any) and any method of the form 
+        "model_N"; a name can't be both. """
+        
+        names = [attr for attr in dir(self) if 
+                re.match("\Amodel_\d+\Z", attr)]
+        if self.plan is not None:
+            both = [name for name in names if name in self.plan]
+            if both:
+                raise ValueError("{0} are both methods and in the plan"
+                        " ({1}).".format(both, self.plan.model_config))
+            names.extend(self.plan.names)
+
+        return sorted(names)
+
+
+    def _design_matrix(self, norm):
+        """ Normalize self.dm (using <norm>) then add any movement 
+        regressors and the dummy, returning the final design matrix. """
+
+        keys = self._dm_keys()
+        if keys is None:
+            dm = self.dm.copy()
+            if norm != None:
+                dm = self._normalize_array(dm, norm)
+        else:
+            if norm != None:
+                keys = self._normalized(keys, norm)
+            dm = self._matrix(keys)
 
         # Add movement regressors... if present
         try:
@@ -522,21 +811,51 @@ class Exp():
         except KeyError:
             pass
         
-        # Append a dummy predictor and run the regression
+        # Append a dummy predictor.
         #
         # Dummy is added at the last minute so it does not
         # interact with normalization or smoothing routines.
         dm_dummy = np.ones((dm.shape[0], dm.shape[1] + 1))
         dm_dummy[0:dm.shape[0], 0:dm.shape[1]] = dm
+
+        return dm_dummy
+
+
+    def fit(self, norm="zscore", design=None, stats=None):
+        """ Calculate the regression parameters and statistics. 
         
-        # Truncate bold or dm_dummy if needed, and Go!
-        try:
-            bold = bold[0:dm_dummy.shape[0]]
-            dm_dummy = dm_dummy[0:len(bold),:]
-        except IndexError:
-            pass
+        <design> - an already factorized design (see simfMRI.glm.factorize) 
+            matching self.dm and <norm>.  If None, it is created. 
+        
+        <stats> - the statistics (see STAT_FIELDS) to calculate.  If None, 
+            those in self.save_fields are, or if that is None too, all 
+            of them. """
 
-        self.glm = GLS(bold, dm_dummy).fit()
+        if (stats is None) and (self.save_fields is not None):
+            stats = [k for k in STAT_FIELDS if k in self.save_fields]
+        
+        bold = self.bold.copy()
+        
+        # Normalize the bold (the dm is 
+        # normalized by _design_matrix())
+        if norm != None:
+            bold = self._normalize_array(bold, norm)
+
+        keys = self._dm_keys()
+        if (design is None) and (keys is not None):
+            design = self._memoize(("design", tuple(keys), norm),
+                    lambda: glm.factorize(self._design_matrix(norm)))
+        elif design is None:
+            design = glm.factorize(self._design_matrix(norm))
+        
+        # Truncate bold or the design if needed, and Go!
+        nrow = design["dm"].shape[0]
+        bold = bold[0:nrow]
+        if len(bold) < nrow:
+            design = glm.factorize(design["dm"][0:len(bold),:])
+        
+        self.design = design
+        self.glm = glm.fit(bold, design, stats)
     
     
     def contrast(self, contrast):
@@ -547,50 +866,21 @@ class Exp():
             of predictors in the model (sans the dummy, which is added
             silently). """
         
-        if self.glm == None:
+        if self.glm is None:
             raise ValueError("No glm present.  Try self.fit()?")
         
-        contrast = self.glm.t_test(contrast)
-            ## This a thin wrapper for 
-            ## statsmodels contrast() method
-
-        return contrast.df_denom, contrast.tvalue, contrast.pvalue
+        return glm.contrast(self.glm, contrast)
 
 
     def print_model_summary(self):
         """ Prints all defined model names and their docstrings. """
 
-        # find all self.model_N attritubes and run them.
-        all_attr = dir(self)
-        all_attr.sort()
-        past_models = []
-        model_count = 0
-        for attr in all_attr:
-            a_s = re.split("_", attr)
-            
-            # Match only model_N where N is an integer
-            if len(a_s) == 2:
-                if (a_s[0] == "model") and (re.match("\A\d+\Z", a_s[1])):
-                    
-                    model_count += 1
-                    model = attr
-                        ## Rename for clarity
-
-                    # Model name must be unique.
-                    if model in past_models:
-                        raise AttributeError(
-                                "{0} was not unique.".format(model))
-                    past_models.append(model)
-
-                    # Now call the model and
-                    # print its info out.
-                    print("{0}. {1}:".format(model_count, model))
-                    try:
-                        func = getattr(self, model)
-                        print(func.im_func.func_doc)                    
-                    except KeyError:
-                        print("Data not Found.  Moving on.")
-                        continue
+        for model_count, model in enumerate(self._model_names()):
+            print("{0}. {1}:".format(model_count + 1, model))
+            if (self.plan is not None) and (model in self.plan):
+                print(self.plan.doc(model))
+            else:
+                print(getattr(self, model).__doc__)
 
 
     def run(self,code):
@@ -599,44 +889,26 @@ class Exp():
         
         <code> - the unique batch or run code for this experiment.
         
-        Models are any method of the form "model_N" where N is an
+        Models are those in self.plan (see populate_models()) or, if 
+        there is no plan, any method of the form "model_N" where N is an
         integer (e.g. model_2, model_1012 or model_666).  Models take no
         arguments.
         """
         
         self.results["batch_code"] = code
+        self._memo = {}
         
-        # find all self.model_N attritubes and run them.
-        all_attr = dir(self)
-        all_attr.sort()
-        past_models = []
-        for attr in all_attr:
-            a_s = re.split("_",attr)
+        for model in self._model_names():
+            # Now call the model and
+            # save its results.
+            print("Fitting {0}.".format(model))
+            try:
+                getattr(self, model)()
+            except KeyError:
+                # Missing model should just be skipped.
+                print("Data not Found.  Moving on.")
+                continue
             
-            # Match only model_N where N is an integer
-            if len(a_s) == 2:
-                if (a_s[0] == "model") and (re.match("\A\d+\Z",a_s[1])):
-                    
-                    model = attr
-                        ## Rename for clarity
-
-                    # Model name must be unique.
-                    if model in past_models:
-                        raise AttributeError(
-                                "{0} was not unique.".format(model))
-                    past_models.append(model)
-
-                    # Now call the model and
-                    # save its results.
-                    print("Fitting {0}.".format(model))
-                    try:
-                        getattr(self, model)()
-                    except KeyError:
-                        # Missing model should just be skipped.
-                        print("Data not Found.  Moving on.")
-                        continue
-                    
-                    self.save_state(name=model)
+            self.save_state(name=model)
         
         return self.results
-        
@@ -0,0 +1,322 @@
+""" A batched ordinary least squares engine.  Fits any number of BOLD
+timecourses against a shared (or per simulation) design matrix using one
+pseudo-inverse and a handful of vectorized products.
+
+Statistics match those of statsmodels GLS (with no sigma, i.e. OLS), and
+are keyed as Exp._reformat_model() expects. """
+import numpy as np
+from scipy.linalg import (qr, qr_insert, qr_delete, solve_triangular, 
+        LinAlgError)
+from scipy.stats import t as stats_t
+
+
+STATS = ("beta", "t", "fvalue", "p", "r", "ci", "resid", "aic", "bic", 
+        "llf", "mse_model", "mse_resid", "mse_total")
+    ## Every statistic fit_batch() can compute
+
+
+def factorize(dm):
+    """ Factorize the design matrix <dm> returning a dict of everything
+    fit_batch() needs to fit any number of BOLD timecourses against it.
+
+    <dm> is either 2d (T x p, shared by all simulations) or 3d
+    (nsim x T x p, one design per simulation). """
+
+    dm = np.asarray(dm, dtype=float)
+    if (dm.ndim < 2) or (dm.ndim > 3):
+        raise ValueError("<dm> must be 2 or 3d.")
+
+    pinv = np.linalg.pinv(dm)
+    cov = np.einsum("...ij,...kj->...ik", pinv, pinv)
+        ## The normalized covariance of the parameters,
+        ## i.e. pinv(dm) * pinv(dm).T
+
+    return {
+        "dm":dm,
+        "pinv":pinv,
+        "cov":cov,
+        "rank":np.linalg.matrix_rank(dm),
+        "const":_const(dm)}
+
+
+def _const(dm):
+    """ 1 if <dm> has a constant, else 0. """
+
+    return np.any(_constant_cols(dm), axis=-1).astype(int)
+
+
+def _constant_cols(dm):
+    """ Like statsmodels, a constant is any column of <dm> that never 
+    changes (and is not all zeros). """
+
+    ptp = dm.max(-2) - dm.min(-2)
+
+    return (ptp == 0) & (dm[...,0,:] != 0)
+
+
+def factorize_qr(dm, q, r, tol=1e-10, const=None):
+    """ As factorize(), but for a 2d <dm> (T x p) whose (full or economic) 
+    QR decomposition, <q> and <r>, is already known; this saves both 
+    SVDs (for the pseudo-inverse and the rank). 
+    
+    If <dm> is rank deficient (judged by the diagonal of <r> and <tol>) 
+    factorize() is used instead.  
+    
+    If known, <const> (see factorize()) saves a pass over <dm>. """
+
+    dm = np.asarray(dm, dtype=float)
+    p = dm.shape[1]
+    r1 = r[0:p,0:p]
+    
+    diag = np.abs(np.diag(r1))
+    if (p == 0) or (diag.min() <= (tol * diag.max())):
+        return factorize(dm)
+
+    rinv = solve_triangular(r1, np.eye(p), check_finite=False)
+    if const is None:
+        const = _const(dm)
+    
+    return {
+        "dm":dm,
+        "pinv":np.dot(rinv, q[:,0:p].T),
+        "cov":np.dot(rinv, rinv.T),
+        "rank":p,
+        "const":const}
+
+
+def update_designs(dm, columns):
+    """ Factorize (see factorize_qr()) the designs made from each list of 
+    <columns> (sorted indices into <dm>, T x p) in turn.  
+    
+    One economic QR decomposition (Q is T x k, for k columns) is updated 
+    (column by column, using scipy.linalg.qr_delete and qr_insert) from 
+    each design to the next, rather than starting afresh.  Each update 
+    costs O(T * k), so designs that differ by a few columns (e.g. nested
+    models) are cheap.  Yields each factorized design. """
+
+    dm = np.asarray(dm, dtype=float)
+    constant = _constant_cols(dm)
+    
+    current = []
+    for cols in columns:
+        cols = list(cols)
+        if current:
+            try:
+                current, q, r = _update_qr(dm, current, cols, q, r)
+            except LinAlgError:
+                current = []
+                    ## An economic QR can't take a column in
+                    ## the span of the others (i.e. when the 
+                    ## design is rank deficient), start afresh.
+        
+        if not current:
+            current = list(cols)
+            q, r = qr(dm[:,current], mode="economic")
+
+        yield factorize_qr(dm[:,cols], q, r, 
+                const=int(constant[cols].any()))
+
+
+def _update_qr(dm, current, cols, q, r):
+    """ Update <q> and <r>, the QR decomposition of the <current> columns 
+    of <dm>, to that of <cols>.  Returns the new columns, q and r. """
+
+    current = list(current)
+    
+    # Delete unwanted columns, right to left,
+    for k in reversed(range(len(current))):
+        if current[k] not in cols:
+            q, r = qr_delete(q, r, k, 1, which="col", check_finite=False)
+            del current[k]
+
+    # then insert the new ones, left to right.
+    for k, col in enumerate(cols):
+        if (k >= len(current)) or (current[k] != col):
+            q, r = qr_insert(q, r, dm[:,col], k, which="col", 
+                    check_finite=False)
+            current.insert(k, col)
+
+    return current, q, r
+
+
+def fit_batch(bold, design, stats=None):
+    """ Regress each row of <bold> (nsim x T, or T) onto <design>, either
+    a design matrix or the result of factorize(<design matrix>).
+
+    <stats> - the names (see STATS) of the statistics to compute.  Only 
+        these, and what they depend on, are calculated.  If None, all are.
+
+    Returns a dict of statistics, each stacked along a leading nsim axis. 
+    It always includes "df_resid" and "scale" (i.e. mse_resid), which 
+    contrast() needs. """
+
+    if stats is None:
+        stats = STATS
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError("Unknown stats: {0}".format(sorted(unknown)))
+    stats = set(stats)
+
+    if not isinstance(design, dict):
+        design = factorize(design)
+
+    dm = design["dm"]
+    pinv = design["pinv"]
+    cov = design["cov"]
+
+    bold = np.asarray(bold, dtype=float)
+    if bold.ndim == 1:
+        bold = bold.reshape(1, bold.shape[0])
+    if bold.shape[1] != dm.shape[-2]:
+        raise ValueError("<bold> and <design> must have the same length.")
+
+    # Solve for all the sims at once.
+    if dm.ndim == 2:
+        beta = np.dot(bold, pinv.T)
+        fitted = np.dot(beta, dm.T)
+    else:
+        beta = np.einsum("sij,sj->si", pinv, bold)
+        fitted = np.einsum("sij,sj->si", dm, beta)
+    resid = bold - fitted
+
+    # Degrees of freedom and residual error 
+    # are needed by (nearly) everything.
+    nobs = float(bold.shape[1])
+    const = np.ones(bold.shape[0]) * design["const"]
+    df_model = (np.ones(bold.shape[0]) * design["rank"]) - const
+    df_resid = nobs - df_model - const
+
+    ssr = (resid ** 2).sum(1)
+    mse_resid = ssr / df_resid
+    
+    results = {
+        "beta":beta,
+        "resid":resid,
+        "mse_resid":mse_resid,
+        "df_resid":df_resid,
+        "scale":mse_resid}
+    
+    # Total sums of squares, and what needs them
+    if stats & set(("fvalue", "r", "mse_model", "mse_total")):
+        tss = np.where(const > 0, 
+                ((bold - bold.mean(1).reshape(-1, 1)) ** 2).sum(1), 
+                (bold ** 2).sum(1))
+        ess = tss - ssr
+        mse_model = ess / df_model
+
+        results["fvalue"] = mse_model / mse_resid
+        results["r"] = 1 - (ssr / tss)
+        results["mse_model"] = mse_model
+        results["mse_total"] = tss / (df_resid + df_model)
+    
+    # Parameter tests
+    if stats & set(("t", "p", "ci")):
+        if dm.ndim == 2:
+            cov_diag = np.diag(cov).reshape(1, -1)
+        else:
+            cov_diag = np.diagonal(cov, axis1=1, axis2=2)
+        bse = np.sqrt(cov_diag * mse_resid.reshape(-1, 1))
+        
+        tvalues = beta / bse
+        results["t"] = tvalues
+        if "p" in stats:
+            results["p"] = 2 * stats_t.sf(
+                    np.abs(tvalues), df_resid.reshape(-1, 1))
+        if "ci" in stats:
+            q = stats_t.ppf(0.975, df_resid).reshape(-1, 1)
+            results["ci"] = np.dstack((beta - q * bse, beta + q * bse))
+                ## 95% intervals, nsim x p x 2
+
+    # Likelihood and information criteria
+    if stats & set(("llf", "aic", "bic")):
+        nobs2 = nobs / 2.
+        llf = -nobs2 * np.log(2 * np.pi) - nobs2 * np.log(ssr / nobs) - nobs2
+        
+        results["llf"] = llf
+        results["aic"] = -2 * llf + 2 * (df_model + const)
+        results["bic"] = -2 * llf + np.log(nobs) * (df_model + const)
+
+    # Return only what was asked for (and
+    # what contrast() needs).
+    return dict((k, v) for k, v in results.items() 
+            if (k in stats) or (k in ("df_resid", "scale")))
+
+
+def orthogonalize(dm, pairs):
+    """ Orthgonalize (by regression) columns of <dm> (T x p, or a stack of 
+    them, nsim x T x p) in one step.  
+    
+    <pairs> is a list of (left, right) column indices; each right column
+    is replaced by its residual after regressing it (with no intercept) 
+    on the original left column. """
+
+    dm = np.asarray(dm, dtype=float)
+    orth_dm = dm.copy()
+    if len(pairs) == 0:
+        return orth_dm
+
+    left, right = np.asarray(pairs, dtype=int).T
+    x = dm[...,left]
+    y = dm[...,right]
+
+    # The (no intercept) slope for every pair,
+    # which is 0 if left is all 0.
+    xx = (x * x).sum(-2)
+    xy = (x * y).sum(-2)
+    slope = np.where(xx > 0, xy / np.where(xx > 0, xx, 1), 0)
+
+    orth_dm[...,right] = y - (x * np.expand_dims(slope, -2))
+
+    return orth_dm
+
+
+def unstack(results):
+    """ Split the stacked <results> of fit_batch() into a list of
+    dicts, one for each simulation. """
+
+    nsim = len(results["df_resid"])
+
+    return [dict((k, v[ii]) for k, v in results.items())
+            for ii in range(nsim)]
+
+
+def fit(bold, design, stats=None):
+    """ Regress a single <bold> timecourse onto <design> (a design matrix or
+    the result of factorize()), returning a dict of <stats> (see 
+    fit_batch()). """
+
+    if not isinstance(design, dict):
+        design = factorize(design)
+
+    results = unstack(fit_batch(bold, design, stats))[0]
+    results["cov"] = design["cov"]
+        ## Needed by contrast()
+
+    return results
+
+
+def contrast(results, contrast):
+    """ Use <results> (from fit()) to statistically compare predictors
+    (t-test), returning df, t and p values.
+
+    <contrast> - a 1d list of [1,0,-1] the same length as the number
+        of predictors in the model.  If it is one short, the dummy
+        predictor is added (as 0) silently. """
+
+    if "beta" not in results:
+        raise ValueError("<results> has no beta.  Refit with it?")
+
+    beta = results["beta"]
+    contrast = np.asarray(contrast, dtype=float)
+    if contrast.shape[0] == (beta.shape[0] - 1):
+        contrast = np.append(contrast, 0)
+
+    effect = np.dot(contrast, beta)
+    se = np.sqrt(np.dot(np.dot(contrast, results["cov"]), contrast) *
+            results["scale"])
+
+    df = results["df_resid"]
+    tvalue = effect / se
+    pvalue = 2 * stats_t.sf(np.abs(tvalue), df)
+
+    return df, tvalue, pvalue
@@ -1,6 +1,26 @@
 """A collection of hemodynamic response functions."""
 import numpy as np
-import scipy.stats as stats
+from scipy.linalg import toeplitz
+from simfMRI.cache import LRUCache, make_key
+from simfMRI.misc import process_prng
+
+
+_CANONICAL = {"a1":6.0, "a2":12.0, "b1":0.9, "b2":0.9, "c":0.35}
+    ## The canonical double gamma parameters
+
+_hrfs = LRUCache(maxsize=128)
+    ## cached_double_gamma() results, keyed
+    ## by their parameters.
+
+
+_DIRECT_MAX = 256
+    ## convolve() uses a direct (matrix) convolution
+    ## for arrays with up to this many rows, and the
+    ## FFT for anything longer.
+
+_kernels = LRUCache(maxsize=32)
+    ## Convolution kernels (Toeplitz matrices or
+    ## FFTs of HRFs), keyed by HRF and length.
 
     
 def double_gamma(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, c=0.35):
@@ -19,6 +39,76 @@ def double_gamma(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, c=0.35):
     return hrf
 
 
+def double_gamma_bank(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, 
+        c=0.35):
+    """
+    Returns a bank of HRFs, one per row, evaluating double_gamma() for every 
+    set of parameters in a single broadcasted call.  
+
+    Each of <a1>, <a2>, <b1>, <b2>, and <c> may be a number or a 1d array;
+    arrays must share a length, numbers are shared by every HRF.
+    """
+    
+    params = np.broadcast_arrays(*[np.asarray(p, dtype=float) 
+            for p in (a1, a2, b1, b2, c)])
+    params = [p.reshape(-1, 1) for p in params]
+        ## Columns broadcast against x_range (a row) 
+        ## inside double_gamma()
+
+    return np.atleast_2d(double_gamma(width, TR, *params))
+
+
+def cached_double_gamma(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, 
+        c=0.35):
+    """
+    As double_gamma() but memoized on the parameters.  The returned HRF is 
+    shared (between callers) so it is read-only.
+    """
+    
+    key = (width, TR, a1, a2, b1, b2, c)
+    hrf = _hrfs.get(key)
+    if hrf is None:
+        hrf = double_gamma(*key)
+        hrf.setflags(write=False)
+        _hrfs.put(key, hrf)
+
+    return hrf
+
+
+def perturb_bank(n, fraction, width=32, TR=1, prng=None):
+    """
+    Sample <n> perturbed canonical HRFs at once.  For each, add scaled 
+    (by <fraction> (0-1)) white noise to a randomly selected canonical 
+    double gamma HRF parameter; the rest keep their canonical values.
+
+    Returns a dict of parameter arrays (each of length <n>, plus <width> 
+    and <TR>), the (n x width/TR) bank of HRFs, and the RandomState() used 
+    for sampling (see simfMRI.misc.process_prng).
+    """
+
+    prng = process_prng(prng)
+
+    names = sorted(_CANONICAL.keys())
+    canonical = np.array([_CANONICAL[name] for name in names])
+    
+    # Pick a parameter for each HRF, and 
+    # perturb it.
+    picked = prng.randint(0, len(names), n)
+    loc = canonical[picked]
+    values = prng.normal(loc=loc, scale=loc / (1. * fraction))
+        ## Grab a random value from the normal curve
+        ## with its SD reduced by 0.fraction
+    
+    table = np.tile(canonical, (n, 1))
+    table[np.arange(n), picked] = values
+
+    params = dict((name, table[:,ii]) for ii, name in enumerate(names))
+    params['width'] = width
+    params['TR'] = TR
+
+    return params, double_gamma_bank(**params), prng
+
+
 def preturb_canonical(fraction, width, TR, prng=None):
     """
     Add scaled (by <fraction> (0-1)) white noise to a randomly selected 
@@ -32,34 +122,82 @@ def preturb_canonical(fraction, width, TR, prng=None):
     
     <width> and <TR> are not used here but are needed for HRF calculations 
     downstream.
+
+    To sample many HRFs at once use perturb_bank().
     """
 
-    prng = process_prng(prng)
-    
-    np.random.set_state(prng.get_state())
-        ## Pass random state from prng to np so that
-        ## stats.<> will inherit the right state.
-        ## There does not seem to be a way to set random
-        ## state of stats.* functions directly.
-    
-    params = {a1:6.0, a2:12.0, b1:0.9, b2:0.9, c:0.35}
-        ## The conanoical parameters
-    
-    keys = params.keys()
-    np.random.shuffle(keys)
-    par = params[keys[0]]
-    
-    params[keys[0]] = stats.norm.rvs(loc=par, scale=par/(1.*fraction))
-        ## Grab a random value from the normal curve
-        ## with its SD reduced by 0.fraction
+    bank, _, prng = perturb_bank(1, fraction, width, TR, prng)
     
+    params = dict((k, float(v[0])) for k, v in bank.items() 
+            if k in _CANONICAL)
     params['width'] = width
     params['TR'] = TR
-        ## Add the remaining (unpreturbed) params
-    
-    prng.set_state(np.random.get_state())
-        ## Pass the seed state from np back to
-        ## prng, then we can use prng again...
     
     return params, prng
 
+
+def _kernel(hrf, nrow):
+    """ Return the (cached) kernel needed to convolve <hrf> with <nrow> 
+    long columns. """
+    
+    key = make_key(hrf, nrow)
+    kernel = _kernels.get(key)
+    if kernel is None:
+        if nrow <= _DIRECT_MAX:
+            # A lower triangular Toeplitz matrix, so
+            # dot(kernel, arr) is the convolution,
+            # already truncated to nrow.
+            first = np.zeros(nrow)
+            first[0:min(nrow, hrf.shape[0])] = hrf[0:nrow]
+            kernel = ("direct", toeplitz(first, np.zeros(nrow)))
+        else:
+            # Pad to a power of 2 at least as long 
+            # as the full (linear) convolution.
+            nfft = 2 ** int(np.ceil(np.log2(nrow + hrf.shape[0] - 1)))
+            kernel = ("fft", np.fft.rfft(hrf, nfft), nfft)
+
+        _kernels.put(key, kernel)
+
+    return kernel
+
+
+def convolve(arr, hrf):
+    """ Convolve <hrf> with every column of <arr> at once, truncating each 
+    to the length of <arr>.  
+    
+    <arr> can be 1d (T), 2d (T x ncol) or 3d (nsim x T x ncol). Short arrays
+    are convolved directly, long ones using the FFT. Either way the kernel
+    is cached for reuse. """
+    
+    arr = np.asarray(arr, dtype=float)
+    hrf = np.asarray(hrf, dtype=float)
+    if hrf.ndim != 1:
+        raise ValueError("<hrf> must be 1d.")
+
+    # Reshape to 2d, with time on the first axis and
+    # every other column (or sim) on the second.
+    shape = arr.shape
+    if arr.ndim == 1:
+        cols = arr.reshape(shape[0], 1)
+    elif arr.ndim == 2:
+        cols = arr
+    elif arr.ndim == 3:
+        cols = np.rollaxis(arr, 1, 0).reshape(shape[1], -1)
+    else:
+        raise ValueError("<arr> must be 1, 2 or 3d.")
+
+    nrow = cols.shape[0]
+    kernel = _kernel(hrf, nrow)
+    if kernel[0] == "direct":
+        conv = np.dot(kernel[1], cols)
+    else:
+        ffthrf, nfft = kernel[1:]
+        conv = np.fft.irfft(
+                np.fft.rfft(cols, nfft, axis=0) * ffthrf.reshape(-1, 1), 
+                nfft, axis=0)[0:nrow]
+
+    # And undo the reshape.
+    if arr.ndim == 3:
+        return np.rollaxis(conv.reshape(shape[1], shape[0], shape[2]), 1, 0)
+    
+    return conv.reshape(shape)
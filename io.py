@@ -1,6 +1,10 @@
 """ Functions for reading and writing of Exp results """
+import os
 import h5py
+import shutil
+import threading
 import numpy as np
+from Queue import Queue
     
 def _walk(d,hdf):
     """ 
@@ -40,35 +44,711 @@ def _unwalk(start, hdf, d=None):
     pass
 
 
-def write_hdf(results,name):
+def _read_group(group):
+    """ Recursively read the hdf5 <group> back into a dict, undoing 
+    _walk(). """
+
+    d = {}
+    for k, v in group.items():
+        if isinstance(v, h5py.Group):
+            d[k] = _read_group(v)
+        else:
+            d[k] = v[()]
+
+    return d
+
+
+class HDFWriter():
+    """ Write results to the hdf5 file <name>, one simulation at a time,
+    mimicking the hierarchical structure of each (the "node" layout). 
+    
+    <indices> is accepted, and ignored, so all writers share a signature 
+    (see create_writer()).  
+    
+    The file is only sure to be readable once closed; to keep results 
+    through a crash use a CheckpointWriter. """
+
+    def __init__(self, name, indices=None, mode="w"):
+        close_readers(name)
+            ## Can't write to a file open for reading
+        
+        self.name = name
+        self.f = h5py.File(name, mode)
+
+
+    def write(self, index, result):
+        """ Write <result> (a dict) as the top level group <index>. Anything
+        that is not a dict is assumed to be data. """
+
+        fg_ii = self.f.create_group(str(index))
+        _walk(result, fg_ii)
+
+
+    def flush(self):
+        self.f.flush()
+
+
+    def close(self):
+        self.f.close()
+
+
+CHUNK_BYTES = 1 << 18
+    ## Columnar datasets are chunked into
+    ## (about) this many bytes of rows,
+
+CACHE_BYTES = 1 << 22
+CACHE_SLOTS = 1009
+    ## and each dataset caches this many bytes 
+    ## of chunks (in a hash table with this many 
+    ## slots, a prime) while writing.
+
+
+def _runs(rows):
+    """ Split the sorted <rows> into runs of consecutive rows, returning a
+    list of (start, stop) positions in <rows>. """
+
+    rows = np.asarray(rows)
+    edges = np.concatenate(
+            ([0], np.flatnonzero(np.diff(rows) != 1) + 1, [len(rows)]))
+
+    return zip(edges[0:-1], edges[1:])
+
+
+class ColumnarWriter():
+    """ Write results to the hdf5 file <name> in the "columnar" layout. 
+    
+    Each statistic of each model is one chunked, compressed dataset with a
+    row per simulation (e.g. /model_01/t is nsim x ncol).  Per simulation 
+    data shared by models (TR, ISI, trials and data) is stored once, at the 
+    top level (e.g. /data/acc), while model metadata (data/meta) becomes 
+    attributes of the model's group. 
+    
+    <indices> lists the simulations (i.e. their batch codes) the file
+    will hold, in row order.  They are stored in /index; /done marks the
+    rows written so far. 
+    
+    Results are held until <block> have arrived (or flush() is called),
+    then each dataset is written with one slice assignment per run of 
+    consecutive rows; writing row by row would decompress and recompress
+    a whole chunk for every row. """
+
+    shared = ("TR", "ISI", "trials", "data")
+        ## Model entries stored once per sim
+
+    def __init__(self, name, indices, mode="w", block=128):
+        if block < 1:
+            raise ValueError("block must be 1 or greater.")
+
+        close_readers(name)
+            ## Can't write to a file open for reading
+        
+        self.name = name
+        self.block = block
+        self.f = h5py.File(name, mode, rdcc_nbytes=CACHE_BYTES, 
+                rdcc_nslots=CACHE_SLOTS)
+        self.f.attrs["layout"] = "columnar"
+        
+        indices = [int(ii) for ii in indices]
+        self.nrow = len(indices)
+        self.rows = dict((ii, row) for row, ii in enumerate(indices))
+            ## Map indices to rows
+
+        if "index" not in self.f:
+            self.f.create_dataset("index", data=np.array(indices))
+            self.f.create_dataset("done", data=np.zeros(self.nrow, bool))
+        self._done = self.f["done"]
+        self._pending = []
+
+
+    def _dataset(self, path, value):
+        """ Get the dataset at <path>, creating it (shaped to hold a 
+        <value> for every row) if needed. """
+        
+        try:
+            return self.f[path]
+        except KeyError:
+            pass
+
+        value = np.asarray(value)
+        dtype = value.dtype
+        nbytes = value.nbytes
+        if dtype.kind in ("S", "U", "O"):
+            dtype = h5py.special_dtype(vlen=str)
+                ## Strings can vary in length
+            nbytes = 64 * max(value.size, 1)
+                ## A guess
+
+        nchunk = max(1, min(self.nrow, CHUNK_BYTES // max(nbytes, 1)))
+            ## Rows per chunk
+
+        shape = (self.nrow, ) + value.shape
+        return self.f.create_dataset(path, shape=shape, dtype=dtype,
+                chunks=(nchunk, ) + value.shape, 
+                compression="gzip", shuffle=True)
+
+
+    def _put(self, path, rows, values):
+        """ Write <values> to the (sorted) <rows> of the dataset at 
+        <path>. """
+
+        values = [0 if v is None else v for v in values]
+            ## h5py does not know 
+            ## what to do with None.
+        
+        dataset = self._dataset(path, values[0])
+        shapes = set(np.shape(value) for value in values)
+        if shapes != set([dataset.shape[1:], ]):
+            raise ValueError(
+                    "The shape of {0} varies between simulations.".format(path))
+        
+        values = np.array(values)
+        for start, stop in _runs(rows):
+            dataset[rows[start]:(rows[start] + stop - start)] = values[
+                    start:stop]
+
+
+    def _columns(self, result):
+        """ Return a list of the (path, value) pairs of <result>, storing
+        its model metadata as it goes. """
+
+        columns = []
+        for k, v in result.items():
+            if not isinstance(v, dict):
+                columns.append((k, v))
+                continue
+            
+            # k is a model
+            for stat, value in v.items():
+                if stat not in self.shared:
+                    columns.append((k + "/" + stat, value))
+                elif stat != "data":
+                    columns.append((stat, value))
+                else:
+                    for name, data in value.items():
+                        if name == "meta":
+                            self._put_meta(k, data)
+                        else:
+                            columns.append(("data/" + name, data))
+
+        return columns
+
+
+    def write(self, index, result):
+        """ Write <result> (a dict) to the row for <index>, once <block>
+        results are waiting. """
+
+        self._pending.append((self.rows[int(index)], result))
+        if len(self._pending) >= self.block:
+            self._write_pending()
+
+
+    def _write_pending(self):
+        """ Write every waiting result, a dataset at a time. """
+
+        if not self._pending:
+            return
+
+        # Gather each path's rows and values, in row order
+        columns = {}
+        for row, result in sorted(self._pending, key=lambda p: p[0]):
+            for path, value in self._columns(result):
+                rows, values = columns.setdefault(path, ([], []))
+                    ## Setdefault as not every result 
+                    ## need have every path
+                rows.append(row)
+                values.append(value)
+
+        for path, (rows, values) in columns.items():
+            self._put(path, rows, values)
+
+        rows = sorted(row for row, result in self._pending)
+        for start, stop in _runs(rows):
+            self._done[rows[start]:(rows[start] + stop - start)] = True
+
+        self._pending = []
+
+
+    def _put_meta(self, model, meta):
+        """ Store <meta> (a dict) as attributes of <model>. """
+
+        group = self.f.require_group(model)
+        for k, v in meta.items():
+            if k not in group.attrs:
+                group.attrs[k] = np.array(v, dtype=str)
+
+
+    def flush(self):
+        self._write_pending()
+        self.f.flush()
+
+
+    def close(self):
+        try:
+            self._write_pending()
+        finally:
+            self.f.close()
+
+
+def create_writer(name, indices, layout="node", mode="w"):
+    """ Return a writer for the hdf5 file <name> that will hold results
+    for <indices>, using <layout> ("node" or "columnar"). """
+
+    if layout == "node":
+        return HDFWriter(name, indices, mode)
+    elif layout == "columnar":
+        return ColumnarWriter(name, indices, mode)
+    else:
+        raise ValueError("Unknown layout: {0}".format(layout))
+
+
+class StreamWriter():
+    """ Pass results to <writer> (e.g. a HDFWriter) from a dedicated
+    thread, so writing overlaps with computing.  At most <maxsize> results
+    wait in the queue; put() blocks when it is full.  
+    
+    Nothing is flushed to disk until close(), so <writer> should be a 
+    CheckpointWriter if results must survive a crash. """
+
+    def __init__(self, writer, maxsize=64):
+        self.writer = writer
+        self.error = None
+        self._queue = Queue(maxsize)
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _loop(self):
+        """ Write whatever arrives in the queue, until None does. """
+        
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            # Once writing fails, just drain the
+            # queue; put() or close() will re-raise.
+            if self.error is None:
+                try:
+                    self.writer.write(*item)
+                except Exception as err:
+                    self.error = err
+
+
+    def put(self, index, result):
+        """ Queue <result> to be written as <index>. """
+        
+        if self.error is not None:
+            raise self.error
+
+        self._queue.put((index, result))
+
+
+    def close(self):
+        """ Wait for the queue to be written, then close the writer. """
+
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+
+        if self.error is not None:
+            raise self.error
+
+
+class CheckpointWriter():
+    """ Write results to the hdf5 file <name> (using <layout>, see 
+    create_writer()) by way of checkpoints.
+    
+    Every <every> results are written (in the node layout) to a new part 
+    file in the <name>.parts directory.  Each part is written under a 
+    temporary name and only renamed once it is complete and closed, so 
+    a crash, even mid-write, loses at most the results not yet in a part. 
+    
+    Once every one of <indices> has been written, close() combines the 
+    parts into <name> and removes them.  Otherwise the parts are kept, 
+    and if <resume> is True a later writer picks up where they left off 
+    (see checkpointed()).  Resuming a run that already finished (i.e. 
+    <name> exists and its parts do not) writes nothing. """
+
+    def __init__(self, name, indices, layout="node", every=100, 
+            resume=False):
+        if every < 1:
+            raise ValueError("every must be 1 or greater.")
+
+        self.name = name
+        self.indices = [int(ii) for ii in indices]
+        self.layout = layout
+        self.every = every
+        self.parts = _parts_dir(name)
+        self._pending = []
+        
+        self.finished = (resume and os.path.exists(name) and 
+                not os.path.isdir(self.parts))
+        if self.finished:
+            self.written = set(self.indices)
+            return
+
+        if (not resume) and os.path.isdir(self.parts):
+            shutil.rmtree(self.parts)
+                ## Stale checkpoints
+        try:
+            os.mkdir(self.parts)
+        except OSError:
+            pass
+        
+        self.written = set(checkpointed(name))
+        self._count = len(_part_names(self.parts))
+
+
+    def write(self, index, result):
+        """ Add <result> as <index>, checkpointing if enough results 
+        are waiting. """
+
+        self._pending.append((int(index), result))
+        if len(self._pending) >= self.every:
+            self.flush()
+
+
+    def flush(self):
+        """ Write all waiting results to a new part. """
+
+        if not self._pending:
+            return
+
+        part = os.path.join(self.parts, "part{0:06d}.hdf5".format(
+                self._count))
+        tmp = part + ".tmp"
+
+        writer = HDFWriter(tmp)
+        try:
+            [writer.write(index, result) for index, result in self._pending]
+        finally:
+            writer.close()
+        os.rename(tmp, part)
+            ## Atomic, so parts are 
+            ## either whole or absent.
+
+        self.written.update(index for index, result in self._pending)
+        self._pending = []
+        self._count += 1
+
+
+    def close(self):
+        """ Checkpoint any waiting results, then if the run is complete 
+        combine the parts into <name>. """
+
+        if self.finished:
+            return
+
+        self.flush()
+        
+        missing = set(self.indices) - self.written
+        if missing:
+            print("{0} of {1} simulations are checkpointed in {2}.".format(
+                    len(self.indices) - len(missing), len(self.indices), 
+                    self.parts))
+            return
+        
+        writer = create_writer(self.name, self.indices, self.layout)
+        try:
+            done = set()
+            for part in _part_names(self.parts):
+                f = h5py.File(os.path.join(self.parts, part), "r")
+                for k in f.keys():
+                    if (int(k) in done) or (int(k) not in self.written):
+                        continue
+                    writer.write(int(k), _read_group(f[k]))
+                    done.add(int(k))
+                f.close()
+        finally:
+            writer.close()
+        
+        shutil.rmtree(self.parts)
+            ## Only once <name> is whole
+
+
+def _parts_dir(name):
+    """ The checkpoint directory for the hdf5 file <name>. """
+
+    return name + ".parts"
+
+
+def _part_names(parts):
+    """ The (sorted) names of the complete part files in <parts>. """
+
+    try:
+        names = os.listdir(parts)
+    except OSError:
+        return []
+
+    return sorted(n for n in names if os.path.splitext(n)[1] == ".hdf5")
+
+
+def checkpointed(name):
+    """ Return a sorted list of the simulation indices checkpointed 
+    for the hdf5 file <name> (see CheckpointWriter). """
+
+    parts = _parts_dir(name)
+
+    indices = set()
+    for part in _part_names(parts):
+        f = h5py.File(os.path.join(parts, part), "r")
+        indices.update(int(k) for k in f.keys())
+        f.close()
+
+    return sorted(indices)
+
+
+def write_hdf(results,name,layout="node"):
     """ 
     Iterate over the <results> list, mimicking the hierarchical structure of 
     each entry.  Name the resulting file <name>.
+
+    If <layout> is "columnar" each statistic is instead stored as a
+    single dataset (see ColumnarWriter).
     """
-    from simfMRI.io import _walk
     
-    f = h5py.File(name,'w')
+    writer = create_writer(name, range(len(results)), layout)
     for ii,r in enumerate(results):
         # Create a top level group for each r
         # in results.  Then recursively walk r.
         # Anything that is not a dict is 
         # assumed to be data.        
-        fg_ii = f.create_group(str(ii))
-        _walk(r,fg_ii)
+        writer.write(ii, r)
     
-    f.close()
+    writer.close()
 
 
 def read_hdf_as_results(hdf):
-    """ Read <hdf> into a 'results' list of dicts matching the format 
-    returned by simfMRI.run(). """
+    """ Read <hdf> (in the node layout) into a 'results' list of dicts 
+    matching the format returned by simfMRI.run(). """
     
-    f = h5py.File(name,'r')
-    # TODO
-    pass
+    reader = open_reader(hdf)
+    if reader.columnar:
+        raise ValueError("{0} is columnar.".format(hdf))
+
+    nodes = sorted(reader.f.keys(), key=int)
+        
+    return [_read_group(reader.f[node]) for node in nodes]
+    
+
+def _is_columnar(f):
+    """ True if the open hdf5 file <f> uses the columnar layout. """
+    
+    return f.attrs.get("layout") == "columnar"
+
+
+def _columnar_path(f, path):
+    """ Map a (node layout) <path> like /model_01/data/acc onto the 
+    columnar layout in <f>, where data shared by models is stored once
+    (e.g. /data/acc). """
+
+    if path in f:
+        return path
+
+    parts = path.strip("/").split("/")
+    if (len(parts) > 1) and (parts[1] in ColumnarWriter.shared):
+        return "/" + "/".join(parts[1:])
+
+    return path
+
+
+class Reader():
+    """ A reading session for the <hdf> file, in either layout.  It keeps
+    one open handle, and caches model names and metadata on first access.
+
+    Use it as a context manager to close the handle deterministically:
+
+        with Reader("simple100.hdf5") as reader:
+            t, aic = reader.fetch([("model_01", "t"), ("model_01", "aic")])
+    """
+    
+    def __init__(self, hdf):
+        self.name = hdf
+        self.f = h5py.File(hdf, 'r')
+        self.columnar = _is_columnar(self.f)
+        
+        self._model_names = None
+        self._model_meta = {}
+        self._rows = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        """ Close the handle (and drop the session from the pool). """
+        
+        key = os.path.abspath(self.name)
+        if _readers.get(key) is self:
+            del _readers[key]
+        self.f.close()
+
+
+    def is_open(self):
+        return bool(self.f.id.valid)
+
+
+    def nodes(self):
+        """ Return the top-level (simulation) groups of a node layout 
+        file. """
+
+        return [self.f[node] for node in self.f.keys()]
+
+
+    def model_names(self):
+        """ Return a list of all the model names. """
+
+        if self._model_names is None:
+            # The top (group) nodes of a sim
+            # are its models
+            if self.columnar:
+                top = self.f
+            else:
+                top = self.f[self.f.keys()[0]]
+
+            names = [k for k in top.keys() if isinstance(top[k], h5py.Group)]
+            if 'data' in names:
+                names.remove('data')
+                    ## In the columnar layout data
+                    ## is shared by every model.
+
+            self._model_names = names
         
-    return results
+        return list(self._model_names)
+
+
+    def model_meta(self, model):
+        """ Get the BOLD and DM metadata for <model>. """
+
+        if model not in self._model_meta:
+            meta = {}
+            if self.columnar:
+                meta['bold'] = self.f[model].attrs['bold']
+                meta['dm'] = self.f[model].attrs['dm'].tolist()
+            else:
+                first = self.f.keys()[0]
+                meta['bold'] = self.f[first][model]['data/meta/bold'][()]
+                meta['dm'] = self.f[first][model]['data/meta/dm'][()].tolist()
+            
+            self._model_meta[model] = meta
+
+        return dict(self._model_meta[model])
+
     
+    def read(self, path='/model_01/t'):
+        """ Return a list of the data specified by <path> for every 
+        (completed) simulation. """
+
+        if self.columnar:
+            return list(self.column(path))
+
+        return [node[path.strip('/')][()] for node in self.nodes()]
+
+
+    def read_inc(self, path='/model_01/t'):
+        """ As read(), but *incrementally*. """
+
+        if self.columnar:
+            for row in self.column(path):
+                yield row
+            return
+
+        for node in self.nodes():
+            yield node[path.strip('/')][()]
+
+
+    def column(self, path='/model_01/t'):
+        """ Return the data specified by <path>, for every (completed) 
+        simulation, as one array with a row per simulation.  For columnar
+        files this is a single slice. """
+
+        if not self.columnar:
+            return np.array(self.read(path))
+
+        data = self.f[_columnar_path(self.f, path)][...]
+
+        return data[self.f["done"][...]]
+
+
+    def sim(self, index, path):
+        """ Return the data at <path> for simulation <index> (its batch 
+        code). """
+
+        if not self.columnar:
+            return self.f[str(index)][path.strip('/')][()]
+        
+        if self._rows is None:
+            self._rows = dict((int(ii), row) 
+                    for row, ii in enumerate(self.f["index"][...]))
+        
+        return self.f[_columnar_path(self.f, path)][self._rows[int(index)]]
+
+
+    def fetch(self, paths):
+        """ Return the data for every (model, stat) pair in <paths>, 
+        in order, as read() would, in a single pass over the file. """
+
+        if self.columnar:
+            return [self.column('/{0}/{1}'.format(*p)) for p in paths]
+
+        fetched = [[] for p in paths]
+        for node in self.nodes():
+            for data, p in zip(fetched, paths):
+                data.append(node['{0}/{1}'.format(*p)][()])
+
+        return fetched
+
+
+_readers = {}
+    ## Open Reader() sessions, keyed
+    ## by (absolute) file name.
+
+
+def open_reader(hdf):
+    """ Return the pooled Reader() for <hdf>, opening one if needed. """
+
+    key = os.path.abspath(hdf)
+    reader = _readers.get(key)
+    if (reader is None) or (not reader.is_open()):
+        reader = Reader(hdf)
+        _readers[key] = reader
+
+    return reader
+
+
+def close_readers(hdf=None):
+    """ Close the pooled Reader() for <hdf>, or if <hdf> is None, 
+    all of them. """
+
+    if hdf is None:
+        names = _readers.keys()
+    else:
+        names = [os.path.abspath(hdf), ]
+
+    for name in names:
+        reader = _readers.get(name)
+        if reader is not None:
+            reader.close()
+
+
+def read_column(hdf, path='/model_01/t'):
+    """ 
+    From a columnar <hdf> file return the data specified by path, for 
+    every (completed) simulation, as one array with a row per simulation. 
+    """
+
+    reader = open_reader(hdf)
+    if not reader.columnar:
+        raise ValueError("{0} is not columnar.".format(hdf))
+
+    return reader.column(path)
+
 
 def read_hdf(hdf,path='/model_01/t'):
     """ 
@@ -76,11 +756,7 @@ def read_hdf(hdf,path='/model_01/t'):
     data specified by path.
     """
 
-    # First locate the dataset in the first result,
-    # then grab that data for every run.
-    f = h5py.File(hdf,'r')
-
-    return [f[node+path].value for node in f.keys()]
+    return open_reader(hdf).read(path)
 
 
 def read_hdf_inc(hdf,path='/model_01/t'):
@@ -89,41 +765,18 @@ def read_hdf_inc(hdf,path='/model_01/t'):
     data specified by path.
     """
 
-    # First locate the dataset in the first result,
-    # then grab that data for every run.
-    f = h5py.File(hdf,'r')
-
-    for node in f.keys():
-        yield f[node+path].value
+    return open_reader(hdf).read_inc(path)
 
 
 def get_model_meta(hdf,model):
     """ Get the BOLD and DM metadata for <model> from <hdf> """
 
-    f = h5py.File(hdf,'r')
-    
     print(model)
     
-    meta = {}
-    meta['bold'] = f['/0/'+ model +'/data/meta/bold'].value
-    meta['dm'] = f['/0/'+ model +'/data/meta/dm'].value.tolist()
-
-    return meta
+    return open_reader(hdf).model_meta(model)
 
 
 def get_model_names(hdf):
     """ Return a list of all the model names in <hdf>. """
     
-    f = h5py.File(hdf,'r')
-    
-    # Get a list of the top nodes in the hdf
-    # as these will be a list of models
-    topn = f['/0/'].keys()
-    topn.remove('batch_code')
-        ## batch_code is not a model 
-        ## but will be in the top
-        ## set of hdf nodes
-    
-    return topn
-
-    
\ No newline at end of file
+    return open_reader(hdf).model_names()
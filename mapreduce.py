@@ -1,40 +1,300 @@
 """ Tools to allow simfMRI experiments to be used in the Hadoop 
 mapreduce-esque way. """
+import os
+import h5py
 import shutil
+import itertools
+import functools
 import numpy as np
-from simfMRI.io import write_hdf, read_hdf
+from Queue import Queue, Empty
+from multiprocessing import Process
+from simfMRI.io import write_hdf, read_hdf, close_readers
 
 
-def create_chunks(nrun, ncore):
-    """ A mapper that divides <nrum> simulations into <ncore> pieces, 
-    returning a list of <ncore> lists, with <nrun> integers counting up
-    from 0 (starting in the first list).
+def create_chunks(nrun, ncore, size=None):
+    """ A mapper that divides <nrun> simulations into pieces, returning a
+    list of lists, with <nrun> integers counting up from 0 (starting in 
+    the first list).
     
-    Note: <ncore> must evenly divide <nrun>. """
+    If <size> is None there are <ncore> (or <nrun>, if fewer) pieces, 
+    as equal as possible.  Otherwise each piece holds <size> integers 
+    (the last may hold fewer); small pieces let a pool keep every core 
+    busy when simulations vary in run time. """
     
-    if (nrun % ncore) == 0:
-        return np.arange(nrun).reshape(ncore, nrun/ncore).tolist()
-    else:
-        raise ValueError("<ncore> must evenly divide <nrun>.")
+    if nrun < 1:
+        return []
+
+    if size is None:
+        if ncore < 1:
+            raise ValueError("<ncore> must be 1 or greater.")
+        return [chunk.tolist() for chunk in 
+                np.array_split(np.arange(nrun), min(ncore, nrun))]
+    
+    if size < 1:
+        raise ValueError("<size> must be 1 or greater.")
+    
+    return [range(start, min(start + size, nrun)) for start in 
+            range(0, nrun, size)]
 
 
-def reduce_chunks(results_in_chunks):
+def reduce_chunks(results_in_chunks, key=None):
     """ Reduce <results_in_chunks> (a list of results lists from a parallel
-    run) to a flat list of results. """
+    run) to a flat list of results.  
+    
+    If <key> is not None, the results are sorted by result[<key>] (e.g. 
+    "batch_code"), undoing any out of order completion. """
     
     results = []
     [results.extend(chunk) for chunk in results_in_chunks]
     
+    if key is not None:
+        results.sort(key=lambda result: result[key])
+
     return results
 
 
+def imap_window(pool, func, chunks, window):
+    """ Like <pool>.imap_unordered(<func>, <chunks>), but with at most 
+    <window> chunks submitted (running, or done but not yet consumed) at 
+    once.
+    
+    Pool.imap_unordered() submits every chunk up front and buffers the 
+    results, however slowly they are consumed (e.g. written); here a slow
+    consumer holds up submission instead, so at most about <window> chunks
+    of results are ever in memory.  Results are returned as they finish 
+    (so one slow chunk doesn't leave the other cores idle; re-sort them, 
+    e.g. with reduce_chunks()), and errors in <func> are re-raised. """
+
+    if window < 1:
+        raise ValueError("<window> must be 1 or greater.")
+
+    chunks = iter(chunks)
+    done = Queue()
+    pending = {}
+    for token, chunk in enumerate(itertools.islice(chunks, window)):
+        pending[token] = pool.apply_async(func, (chunk, ), 
+                callback=functools.partial(_put_done, done, token))
+    
+    token = len(pending)
+    while pending:
+        try:
+            finished, result = done.get(timeout=0.1)
+        except Empty:
+            [failed.get() for failed in pending.values() 
+                    if failed.ready() and not failed.successful()]
+                ## Failures never reach the callback,
+                ## so look for them, and re-raise
+            continue
+
+        del pending[finished]
+        for chunk in itertools.islice(chunks, 1):
+            pending[token] = pool.apply_async(func, (chunk, ), 
+                    callback=functools.partial(_put_done, done, token))
+            token += 1
+                ## Keep the pool busy while 
+                ## result is consumed
+
+        yield result
+
+
+def _put_done(done, token, result):
+    """ Put the <result> of the chunk <token> in the <done> Queue. """
+
+    done.put((token, result))
+
+
+def shard_indices(nrun, k, nshard):
+    """ Return the indices of shard <k> (counting from 0) when <nrun> 
+    simulations are split into <nshard> contiguous, near-equal shards. """
+    
+    if (k < 0) or (k >= nshard):
+        raise ValueError("<k> must be in 0...{0}.".format(nshard - 1))
+    
+    return np.array_split(np.arange(nrun), nshard)[k].tolist()
+
+
+def shard_from_env():
+    """ Return the (k, nshard) of this node, read from the SIMFMRI_SHARD
+    and SIMFMRI_NSHARD environment variables (e.g. set from a batch 
+    scheduler's array job index). """
+    
+    try:
+        return int(os.environ["SIMFMRI_SHARD"]), int(
+                os.environ["SIMFMRI_NSHARD"])
+    except KeyError:
+        raise ValueError("Set SIMFMRI_SHARD and SIMFMRI_NSHARD, or pass"
+                " the shard in.")
+
+
+def shard_name(name, k, nshard):
+    """ The name of the results of shard <k> of <nshard> for <name>. """
+
+    return "{0}_shard{1}of{2}".format(name, k, nshard)
+
+
+def run_shards(run, name, nshard):
+    """ Emulate <nshard> nodes locally, running each shard of <run> (a 
+    Run instance) in its own process, as run.go_shard(<name>, k, <nshard>)
+    would on node k.  Returns the paths of the shard files. """
+    
+    procs = [Process(target=run.go_shard, args=(name, k, nshard)) 
+            for k in range(nshard)]
+    [proc.start() for proc in procs]
+    [proc.join() for proc in procs]
+    
+    failed = [k for k, proc in enumerate(procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError("Shards {0} failed.".format(failed))
+
+    return [os.path.join(run.savedir, shard_name(name, k, nshard) + ".hdf5")
+            for k in range(nshard)]
+
+
+def merge_shards(paths, name):
+    """ Merge the shard files in <paths> (see Run.go_shard) into <name>
+    without copying any data.  Columnar shards become virtual datasets 
+    (with rows ordered by simulation index), node layout shards become 
+    external links.  Either way readers (see simfMRI.io) see one file.
+    
+    The shards are found relative to <name>, so they must move with it.  
+    To make a standalone copy, see consolidate(). """
+
+    close_readers(name)
+    
+    shards = [h5py.File(path, "r") for path in paths]
+    merged = h5py.File(name, "w")
+    try:
+        columnar = [shard.attrs.get("layout") == "columnar" 
+                for shard in shards]
+        if all(columnar):
+            _merge_columnar(shards, paths, name, merged)
+        elif not any(columnar):
+            _merge_nodes(shards, paths, name, merged)
+        else:
+            raise ValueError("Shards must share a layout.")
+    finally:
+        merged.close()
+        [shard.close() for shard in shards]
+
+
+def _relpath(path, name):
+    """ <path> relative to the directory holding <name>. """
+
+    return os.path.relpath(os.path.abspath(path), 
+            os.path.dirname(os.path.abspath(name)))
+
+
+def _datasets(f):
+    """ Return the paths of all datasets in the hdf5 file <f>. """
+
+    paths = []
+    f.visititems(lambda path, node: paths.append(path)
+            if isinstance(node, h5py.Dataset) else None)
+
+    return paths
+
+
+def _copy_attrs(src, dst):
+    """ Copy the attributes of <src>'s root and groups to <dst>. """
+
+    dst.attrs.update(src.attrs)
+    
+    groups = []
+    src.visititems(lambda path, node: groups.append(path)
+            if isinstance(node, h5py.Group) else None)
+    for group in groups:
+        dst.require_group(group).attrs.update(src[group].attrs)
+
+
+def _merge_columnar(shards, paths, name, merged):
+    """ Map every dataset of the columnar <shards> into <merged>. """
+
+    shards = sorted(zip(shards, paths), key=lambda s: 
+            (len(s[0]["index"]) == 0, s[0]["index"][0:1].tolist()))
+        ## Empty shards last
+    nrows = [shard["index"].shape[0] for shard, path in shards]
+    
+    full = [shard for (shard, path), nrow in zip(shards, nrows) if nrow > 0]
+    full = full or [shards[0][0], ]
+        ## Empty shards hold only index and done, 
+        ## so only non-empty shards (if any) have 
+        ## the datasets, and their shapes and dtypes
+    datasets = []
+    for shard in full:
+        datasets.extend(dataset for dataset in _datasets(shard) 
+                if dataset not in datasets)
+
+    for dataset in datasets:
+        first = [shard[dataset] for shard in full if dataset in shard][0]
+        layout = h5py.VirtualLayout(
+                shape=(sum(nrows), ) + first.shape[1:], dtype=first.dtype)
+        
+        start = 0
+        for (shard, path), nrow in zip(shards, nrows):
+            if (dataset in shard) and (nrow > 0):
+                layout[start:start + nrow] = h5py.VirtualSource(
+                        _relpath(path, name), dataset, 
+                        shape=shard[dataset].shape)
+            start += nrow
+        
+        merged.require_group(os.path.dirname(dataset) or "/")
+        merged.create_virtual_dataset(dataset, layout)
+    
+    [_copy_attrs(shard, merged) for shard, path in reversed(shards)]
+        ## The first shard's attributes win
+
+
+def _merge_nodes(shards, paths, name, merged):
+    """ Link every simulation (top-level group) of the node layout 
+    <shards> into <merged>. """
+
+    for shard, path in zip(shards, paths):
+        for node in shard.keys():
+            merged[node] = h5py.ExternalLink(_relpath(path, name), "/" + node)
+
+
+def consolidate(name, out, rows=256):
+    """ Copy <name> (e.g. from merge_shards()) into the standalone file 
+    <out>, reading at most <rows> simulations of each dataset at a time. """
+
+    close_readers(out)
+
+    src = h5py.File(name, "r")
+    dst = h5py.File(out, "w")
+    try:
+        if src.attrs.get("layout") != "columnar":
+            for node in src.keys():
+                src.copy(src[node], dst, name=node)
+                    ## Follows the links, copying 
+                    ## one simulation at a time
+        else:
+            for dataset in _datasets(src):
+                data = src[dataset]
+                nrow = data.shape[0]
+
+                chunks = None
+                if nrow > 0:
+                    chunks = (min(nrow, rows), ) + data.shape[1:]
+                copy = dst.create_dataset(dataset, shape=data.shape, 
+                        dtype=data.dtype, chunks=chunks, 
+                        compression="gzip", shuffle=True)
+
+                for start in range(0, nrow, rows):
+                    copy[start:start + rows] = data[start:start + rows]
+
+            _copy_attrs(src, dst)
+    finally:
+        src.close()
+        dst.close()
+
+
 def write_to_tmp(name, pid, results):
     """ Save the <results> list to ./tmp/<pid> """
     
     mk_tmp(pid)
 
     basedir = "tmp"
-    write_hdf(results, os.path.join(basedir, pid, name+".hdf5"))
+    write_hdf(results, os.path.join(basedir, str(pid), name+".hdf5"))
 
 
 def reduce_tmp_files(pid):
@@ -46,22 +306,34 @@ def reduce_tmp_files(pid):
     or old data is silently overwritten. """
     
     basedir = "tmp"
-    reduced = h5py.File(os.join.path(basedir, pid+".hdf5"), "a")
+    pid = str(pid)
+    reduced = h5py.File(os.path.join(basedir, pid+".hdf5"), "a")
         ## Init
 
-    names = sorted(os.listdir(os.join.path(basedir, pid)))
+    names = sorted(os.listdir(os.path.join(basedir, pid)))
     for name in names:
-        if os.path.splitext(filename)[1] == ".hdf5":
+        if os.path.splitext(name)[1] == ".hdf5":
             # Open the next tmp files
             # get the paths to all its data
             # and add then to reduced.
-            tmp = h5py.File(os.join.path(basedir, pid, name), "r")
+            tmp = h5py.File(os.path.join(basedir, pid, name), "r")
             paths = []
-            tmp.visit(paths.append) ## Adds all data paths in hdf
-                                    ## to paths
+            tmp.visititems(lambda path, node: paths.append(path) 
+                    if isinstance(node, h5py.Dataset) else None) 
+                ## Adds all data paths in hdf
+                ## to paths
             
             for path in paths:
-                reduced[path] = tmp[path].value
+                if path in reduced:
+                    del reduced[path]
+                parent, leaf = os.path.split(path)
+                tmp.copy(tmp[path], reduced.require_group(parent or "/"), 
+                        name=leaf)
+                    ## Copied by HDF5 itself, so nothing
+                    ## is read into memory.
+            tmp.close()
+
+    reduced.close()
 
     # And destroy the ./tmp/<pid> directory
     rm_tmp(pid)
@@ -79,7 +351,7 @@ def mk_tmp(pid):
     
     try:
         # Create ./tmp/<pid> if needed
-        os.mkdir(os.join.path(basedir, pid))
+        os.mkdir(os.path.join(basedir, str(pid)))
     except OSError:
         pass
 
@@ -88,5 +360,5 @@ def rm_tmp(pid):
    """ Delete a ./tmp/<pid> subdirectory (even if it contains data). """ 
    
    basedir = "tmp"
-   shutil.rmtree(os.join.path(basedir, pid))
+   shutil.rmtree(os.path.join(basedir, str(pid)))
 
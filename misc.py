@@ -19,3 +19,13 @@ def process_prng(prng):
     
     return prng
 
+
+
+def sim_prng(seed, index):
+    """ Return a RandomState() for simulation <index> of a run seeded
+    with <seed>.  
+    
+    Each (<seed>, <index>) pair gets its own stream, so a simulation's 
+    numbers do not depend on how (or where) the run was split up. """
+
+    return np.random.RandomState([seed, index])
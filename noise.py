@@ -1,7 +1,44 @@
 """ Noise models. """
+import os
 import numpy as np
-import scipy.stats as stats
+from scipy.signal import lfilter
 from simfMRI.misc import process_prng
+from simfMRI.cache import LRUCache
+
+
+_drift_bases = LRUCache(maxsize=32)
+    ## Cumulative drift bases (see _drift_basis()),
+    ## keyed by (N, TR).
+
+
+def _drift_basis(N, TR):
+    """ Return the (cached, read-only) cumulative low frequency drift 
+    basis for timecourses of length <N> sampled every <TR>.  
+    
+    Column j is the sum of the cosine bases of order 1, ..., j, i.e. the
+    drift lowfreqdrift() makes using nbasis = j + 1. It has a column for 
+    every nbasis the slowest drift (0.002 Hz) can need. """
+
+    key = (N, TR)
+    basis = _drift_bases.get(key)
+    if basis is None:
+        max_nbasis = int(np.floor(2 * (N * TR) / 66. + 1))
+        
+        # Creates the drifts; magic! Each basis is a
+        # cosine of order k = 1, 2, ..., max_nbasis - 1.
+        idx = np.arange(0, N).reshape(-1, 1)
+        order = np.arange(1, max_nbasis)
+        drifts = np.sqrt(2. / N) * 10. * np.cos(
+                np.pi * (2. * idx + 1.) * order / (2. * N))
+        
+        basis = np.zeros((N, max_nbasis))
+        basis[:,1:] = np.cumsum(drifts, axis=1)
+            ## Column 0 (nbasis = 1) has no drift
+        
+        basis.setflags(write=False)
+        _drift_bases.put(key, basis)
+
+    return basis
 
 
 def white(N, sigma=1, prng=None):
@@ -14,19 +51,20 @@ def white(N, sigma=1, prng=None):
         RandomState(<prng>)).
     If <prng> is None, the seed is set automagically. """
     
-    prng = process_prng(prng)
+    noise, prng = white_batch(1, N, sigma, prng)
     
-    np.random.set_state(prng.get_state())
-        ## Pass random state from prng to np so that
-        ## stats.<> will inherit the irght state.
-        ## There does not seem to be a way to set random
-        ## state of stats.* functions directly.
+    return noise[0], prng
+
+
+def white_batch(nsim, N, sigma=1, prng=None):
+    """ Create and return <nsim> white noise arrays of length <N>, as 
+    a (nsim, N) array.  See white() for notes on <prng>. """
     
-    noise = stats.norm.rvs(size=N, loc=0, scale=sigma)
+    prng = process_prng(prng)
     
-    prng.set_state(np.random.get_state())
-        ## Pass the seed stat from np back to
-        ## prng, then we can use prng again...
+    noise = prng.normal(loc=0, scale=sigma, size=(nsim, N))
+        ## Draws exactly as stats.norm.rvs() would,
+        ## but from prng directly.
     
     return noise, prng
 
@@ -47,20 +85,22 @@ def ar1(N, alpha=0.2, prng=None):
         RandomState(<prng>)).
     If <prng> is None, the seed is set automagically. """
     
+    arnoise, prng = ar1_batch(1, N, alpha, prng)
+    
+    return arnoise[0], prng
+
+
+def ar1_batch(nsim, N, alpha=0.2, prng=None):
+    """ Create <nsim> AR1 noise arrays (of length <N>, and strength 
+    <alpha>) as a (nsim, N) array.  See ar1() for details. """
+
     if (alpha > 1) or (alpha < 0):
         raise ValueError("alpha must be between 0-1.")
     
-    prng = process_prng(prng)
-    
-    noise, prng = white(N=N, prng=prng)
-    arnoise = [noise[0], ]
-        ## Init by copying over the first
-        ## so the loop below
-        ## has someting to work with for
-        ## the first iteration
-    
-    [arnoise.append(noise[ii]+(alpha * noise[ii-1])) for ii in range(
-            1, len(noise))]
+    noise, prng = white_batch(nsim, N, prng=prng)
+    arnoise = lfilter([1., alpha], [1.], noise, axis=1)
+        ## i.e. arnoise[ii] = noise[ii] + (alpha * noise[ii-1]),
+        ## with the first entry copied over as is.
     
     return arnoise, prng
 
@@ -80,7 +120,17 @@ def physio(N, TR, sigma=1, freq_heart=1.17, freq_resp=0.2, prng=None):
     If <prng> is a number that number is used to seed (i.e., 
         RandomState(<prng>)).
     If <prng> is None, the seed is set automagically. """
-        
+    
+    noise, prng = physio_batch(1, N, TR, sigma, freq_heart, freq_resp, prng)
+    
+    return noise[0], prng
+
+
+def physio_batch(nsim, N, TR, sigma=1, freq_heart=1.17, freq_resp=0.2, 
+        prng=None):
+    """ Create <nsim> periodic physiological noise arrays of length <N> 
+    as a (nsim, N) array.  See physio() for details. """
+
     # Calculate rates
     heart_beat = 2 * np.pi * freq_heart * TR
     resp_rate = 2 * np.pi * freq_resp * TR
@@ -97,7 +147,7 @@ def physio(N, TR, sigma=1, freq_heart=1.17, freq_resp=0.2, prng=None):
     
     # Create the white noise then
     # add the weighted physio
-    noise, prng = white(N=N, prng=prng) 
+    noise, prng = white_batch(nsim, N, prng=prng) 
     noise += hr_weight * hr_drift
     
     return noise, prng
@@ -126,34 +176,30 @@ def lowfreqdrift(N, TR, prng=None):
     If <prng> is None, the seed is set automagically.
     """
 
+    noise, prng = lowfreqdrift_batch(1, N, TR, prng)
+
+    return noise[0], prng
+
+
+def lowfreqdrift_batch(nsim, N, TR, prng=None):
+    """ Create <nsim> low frequency drift noise arrays of length <N> as
+    a (nsim, N) array, each with its own randomly selected frequency.  
+    See lowfreqdrift() for details. """
+
     prng = process_prng(prng)
     
-    freq = prng.randint(66, 500)
+    freq = prng.randint(66, 500, nsim)
         ## i.e. 0.002-0.015 Hz
     
     ## The number of bases is n
-    nbasis = int(np.floor(2 * (N * TR) / freq + 1))
-
-    ## Creates the drifts; magic!
-    def _gen_drifts(nrow, ncol):
-        idx = np.arange(0, nrow)
-
-        drifts = np.zeros((nrow, ncol+1))
-        drifts[:,0] = np.repeat(1 / np.sqrt(nrow), nrow)
-        for col in range(2, ncol+1):
-            drift = np.sqrt(2. / nrow) * 10. * np.cos(
-                    np.pi * (2. * idx + 1.) * (col - 1.) / (2. * nrow))
-            drifts[:, col] = drift
-            
-        return drifts
-    
-    noise = _gen_drifts(N, nbasis)
-    noise = noise[:,1:]     ## Drop the first col
-    noise = noise.sum(1)    ## Sum the rows, creating
-                            ## creating the final noise
+    nbasis = np.floor(2 * (N * TR) / freq.astype(float) + 1).astype(int)
+
+    # Look up the summed drifts for each 
+    # sim's nbasis.
+    noise = _drift_basis(N, TR)[:, nbasis - 1].T
     
     # Now add white noise
-    whiten, prng = white(N, sigma=1, prng=prng)
+    whiten, prng = white_batch(nsim, N, sigma=1, prng=prng)
     noise += whiten
 
     return noise, prng
@@ -196,3 +242,133 @@ def onef(N, fraction, prng=None):
     
     raise NotImplementedError("TODO")
 
+
+_banks = {}
+    ## Memory-mapped noise banks, keyed by (absolute)
+    ## path, so every NoiseBank in a process shares one.
+
+
+class NoiseBank():
+    """ Noise drawn from a bank of real (e.g. residual) timeseries, saved
+    (by np.save) as a 2d (nseries x T) .npy file at <path>.  The bank is
+    memory-mapped, never loaded, so it can be many GB.
+    
+    Call an instance like the other noise functions, noise_f(N, prng), 
+    so it can be used as Exp.noise_f.  Each draw is a random length <N> 
+    segment of a random series, resampled by <method>:
+
+        None - the segment as is (a read-only view of the bank, no copy)
+        "phase" - phase randomized (keeps its power spectrum)
+        "block" - a moving block bootstrap of <block> long pieces
+            (<block> must be shorter than <N>)
+
+    If <sigma> is not None, each draw is z-scored then scaled by it.
+
+    Pickling (e.g. for a Pool) keeps only the path; each process maps the
+    bank once, when first needed. """
+
+    def __init__(self, path, method=None, block=10, sigma=None):
+        if method not in (None, "phase", "block"):
+            raise ValueError("method must be None, 'phase' or 'block'.")
+        if block < 1:
+            raise ValueError("block must be 1 or greater.")
+
+        self.path = os.path.abspath(path)
+            ## So a chdir() can't change the bank
+        self.method = method
+        self.block = block
+        self.sigma = sigma
+        
+        bank = self._data()
+            ## Fail early if the bank is bad
+        if (method == "block") and (block >= bank.shape[1]):
+            raise ValueError("block must be shorter than the bank's series"
+                    " ({0}).".format(bank.shape[1]))
+
+
+    def _data(self):
+        """ Return the (nseries x T) bank, mapping it if needed. """
+
+        bank = _banks.get(self.path)
+        if bank is None:
+            bank = np.load(self.path, mmap_mode="r")
+            if bank.ndim == 1:
+                bank = bank.reshape(1, -1)
+            elif bank.ndim != 2:
+                raise ValueError("The bank must be 1 or 2d.")
+
+            _banks[self.path] = bank
+
+        return bank
+
+
+    def _segments(self, nsim, N, prng):
+        """ Return a list of <nsim> random length <N> segments (views)
+        of the bank. """
+
+        bank = self._data()
+        nseries, T = bank.shape
+        if N > T:
+            raise ValueError("N is longer than the bank's series ({0}).".format(
+                    T))
+
+        series = prng.randint(0, nseries, size=nsim)
+        starts = prng.randint(0, T - N + 1, size=nsim)
+
+        return [np.asarray(bank[ii, start:(start + N)]) 
+                for ii, start in zip(series, starts)]
+
+
+    def _resample(self, noise, prng):
+        """ Resample <noise> (nsim x N) using self.method and scale it, 
+        returning a new array (unless there is nothing to do). """
+
+        nsim, N = noise.shape
+        if self.method == "phase":
+            freq = np.fft.rfft(noise, axis=1)
+            phase = prng.uniform(0, 2 * np.pi, size=freq.shape)
+            phase[:,0] = 0
+            if (N % 2) == 0:
+                phase[:,-1] = 0
+                    ## Keep DC and Nyquist real
+            noise = np.fft.irfft(np.abs(freq) * np.exp(1j * phase), n=N, 
+                    axis=1)
+        elif self.method == "block":
+            if self.block >= N:
+                raise ValueError("block must be shorter than N.")
+            nblock = int(np.ceil(N / float(self.block)))
+            starts = prng.randint(0, N - self.block + 1, size=(nsim, nblock))
+            index = (starts.reshape(nsim, nblock, 1) + 
+                    np.arange(self.block)).reshape(nsim, -1)[:,0:N]
+            noise = noise[np.arange(nsim).reshape(-1, 1), index]
+
+        if self.sigma is not None:
+            std = noise.std(1).reshape(-1, 1)
+            noise = np.nan_to_num(
+                    (noise - noise.mean(1).reshape(-1, 1)) / std) * self.sigma
+
+        return noise
+
+
+    def __call__(self, N, prng=None):
+        """ Return a length <N> draw from the bank. See white() for notes 
+        on <prng>. """
+
+        prng = process_prng(prng)
+
+        noise = self._segments(1, N, prng)[0]
+        if (self.method is None) and (self.sigma is None):
+            return noise, prng
+
+        return self._resample(noise.reshape(1, -1), prng)[0], prng
+
+
+    def batch(self, nsim, N, prng=None):
+        """ Return <nsim> draws of length <N> from the bank, as a 
+        (nsim, N) array.  See white() for notes on <prng>. """
+
+        prng = process_prng(prng)
+
+        noise = np.array(self._segments(nsim, N, prng)).reshape(nsim, N)
+        
+        return self._resample(noise, prng), prng
@@ -0,0 +1,247 @@
+""" Mergeable streaming summaries of simulation results, so a Run can
+keep (say) the distribution of t for every model without keeping (or
+saving) every simulation. """
+import numpy as np
+from collections import Counter
+from simfMRI.glm import STATS
+
+
+SUMMARIZABLE = tuple(stat for stat in STATS if stat not in ("ci", "resid"))
+    ## Stats with one value per sim, or one 
+    ## per DM column, so they can be summarized
+
+
+class Accumulator():
+    """ Streaming summary of a statistic with <names> columns: moments
+    (Welford), a sparse histogram with fixed <width> bins (which doubles 
+    as a quantile sketch) and counts of values above each of <criteria>.
+
+    The histogram only holds the bins that were hit, so its size depends
+    on the spread of the values (in bins), not on their range; an outlier
+    costs one bin.
+
+    Accumulators with the same names, width and criteria can be merged
+    (in any order), so they can be filled in parallel. """
+
+    def __init__(self, names, width=0.01, criteria=()):
+        if width <= 0:
+            raise ValueError("width must be greater than 0.")
+
+        self.names = list(names)
+        self.width = float(width)
+        self.criteria = tuple(criteria)
+
+        ncol = len(self.names)
+        self.n = np.zeros(ncol, dtype=int)
+        self.mean = np.zeros(ncol)
+        self.m2 = np.zeros(ncol)
+            ## Sum of squared deviations from the mean
+        self.exceed = np.zeros((ncol, len(self.criteria)), dtype=int)
+
+        self.counts = [Counter() for name in self.names]
+            ## For each column, counts keyed by bin 
+            ## (bin ii is centered on ii * width)
+
+
+    def _combine(self, n, mean, m2):
+        """ Fold the moments of another sample into these (Chan et al's
+        pairwise update). """
+
+        total = self.n + n
+        safe = np.where(total > 0, total, 1)
+        delta = mean - self.mean
+
+        self.mean = self.mean + delta * (n / safe.astype(float))
+        self.m2 = self.m2 + m2 + (delta ** 2) * (self.n * n /
+                safe.astype(float))
+        self.n = total
+
+
+    def add(self, values):
+        """ Add <values>, one (ncol) or many (nsim x ncol) simulations
+        worth.  Non-finite values are skipped. """
+
+        values = np.asarray(values, dtype=float)
+        values = values.reshape(-1, len(self.names))
+        finite = np.isfinite(values)
+
+        # Moments of the batch, then combine
+        n = finite.sum(0)
+        safe = np.where(n > 0, n, 1).astype(float)
+        filled = np.where(finite, values, 0)
+        mean = filled.sum(0) / safe
+        m2 = (np.where(finite, values - mean, 0) ** 2).sum(0)
+        self._combine(n, mean, m2)
+
+        # Exceedances
+        for jj, criterion in enumerate(self.criteria):
+            self.exceed[:,jj] += (finite & (filled > criterion)).sum(0)
+
+        # Histogram
+        binned = np.round(filled / self.width)
+        for counts, col, keep in zip(self.counts, binned.T, finite.T):
+            bins, hits = np.unique(col[keep], return_counts=True)
+            counts.update(dict(zip(bins.tolist(), hits.tolist())))
+                ## Bins stay (whole) floats, so
+                ## huge values can't overflow
+
+
+    def merge(self, other):
+        """ Merge <other> (an Accumulator) into this one, returning self. """
+
+        if ((other.names != self.names) or (other.width != self.width) or
+                (other.criteria != self.criteria)):
+            raise ValueError("Can only merge matching Accumulators.")
+
+        self._combine(other.n, other.mean, other.m2)
+        self.exceed += other.exceed
+
+        [counts.update(more) for counts, more in zip(self.counts, 
+                other.counts)]
+
+        return self
+
+
+    def quantile(self, q):
+        """ Estimate the <q> quantile (0-1) of each column from the
+        histogram.  As np.percentile() does, it interpolates between the
+        values on either side of q * (n - 1), but uses their bins' centers,
+        so it is accurate to within half a bin width. """
+
+        quantiles = np.repeat(np.nan, len(self.names))
+        for ii, (counts, n) in enumerate(zip(self.counts, self.n)):
+            if n == 0:
+                continue
+            bins = np.array(sorted(counts.keys()))
+            cdf = np.cumsum([counts[b] for b in bins])
+            
+            position = q * (n - 1)
+            lo, hi = bins[np.searchsorted(cdf, 
+                    [np.floor(position), np.ceil(position)], side="right")]
+                ## The bins of the values (sorted, 
+                ## counting from 0) at each side
+            quantiles[ii] = (lo + (hi - lo) * (position - np.floor(position))
+                    ) * self.width
+
+        return quantiles
+
+
+    def std(self):
+        """ The (sample) standard deviation of each column. """
+
+        return np.sqrt(self.m2 / np.where(self.n > 1, self.n - 1, np.nan))
+
+
+    def summary(self):
+        """ Return a dict, keyed by column name, of the mean, n, std, se,
+        median and fraction above each criterion (as above_<criterion>),
+        like simfMRI.analysis.stat.summary(). """
+
+        std = self.std()
+        se = std / np.sqrt(self.n)
+        median = self.quantile(0.5)
+        above = self.exceed / np.where(self.n > 0, self.n, np.nan).reshape(
+                -1, 1)
+
+        summaries = {}
+        for ii, name in enumerate(self.names):
+            summaries[name] = {
+                "mean":self.mean[ii],
+                "n":self.n[ii],
+                "std":std[ii],
+                "se":se[ii],
+                "median":median[ii]}
+            for jj, criterion in enumerate(self.criteria):
+                summaries[name]["above_{0}".format(criterion)] = above[ii,jj]
+
+        return summaries
+
+
+class Summary():
+    """ An Accumulator for each of <stats> in every model of the results
+    it is given. Pass each simulation's results to add() (which then can
+    be discarded), and merge() Summaries from other processes. """
+
+    def __init__(self, stats=("t", "beta"), width=0.01, criteria=()):
+        unknown = [stat for stat in stats if stat not in SUMMARIZABLE]
+        if unknown:
+            raise ValueError("Can't summarize {0}, use any of {1}.".format(
+                    unknown, SUMMARIZABLE))
+
+        self.stats = tuple(stats)
+        self.width = width
+        self.criteria = tuple(criteria)
+        self.accumulators = {}
+            ## Keyed by (model, stat)
+        self.nsim = 0
+
+
+    def add(self, result):
+        """ Add a single simulation's <result> (see Exp.run()).
+
+        As in simfMRI.analysis.stat.load(), stats with n entries lose the
+        last (the dummy) and the rest are named using the model's design
+        matrix metadata. """
+
+        for model, res in result.items():
+            if not isinstance(res, dict):
+                continue
+
+            for stat in self.stats:
+                try:
+                    values = np.asarray(res[stat], dtype=float)
+                except KeyError:
+                    continue
+
+                if values.ndim == 0:
+                    names = [stat, ]
+                    values = values.reshape(1)
+                else:
+                    values = values[0:-1]
+                    names = res["data"]["meta"]["dm"][0:values.shape[0]]
+
+                key = (model, stat)
+                if key not in self.accumulators:
+                    self.accumulators[key] = Accumulator(
+                            names, self.width, self.criteria)
+                self.accumulators[key].add(values)
+
+        self.nsim += 1
+
+
+    def merge(self, other):
+        """ Merge <other> (a Summary) into this one, returning self. """
+
+        for key, acc in other.accumulators.items():
+            if key in self.accumulators:
+                self.accumulators[key].merge(acc)
+            else:
+                self.accumulators[key] = acc
+        self.nsim += other.nsim
+
+        return self
+
+
+    def summary(self):
+        """ Return a dict of dicts, keyed by model then stat, of
+        Accumulator.summary()s. """
+
+        summaries = {}
+        for (model, stat), acc in self.accumulators.items():
+            summaries.setdefault(model, {})[stat] = acc.summary()
+
+        return summaries
+
+
+def merge(summaries):
+    """ Merge a list of <summaries> (Summary or Accumulator objects) into
+    the first, returning it. """
+
+    summaries = list(summaries)
+    if len(summaries) == 0:
+        return None
+
+    first = summaries[0]
+    [first.merge(summary) for summary in summaries[1:]]
+
+    return first
@@ -0,0 +1,221 @@
+""" Model plans: the models of a model config (.ini) file, parsed and
+checked once so they can be bound to any number of Exp instances. """
+import re
+import ast
+import inspect
+import itertools
+import ConfigParser
+from simfMRI.glm import STATS
+
+
+REQUIRED = ("norm", "bold", "dm", "dm_params", "bold_params")
+    ## Every model section needs these
+
+OPTIONAL = ("stats", )
+    ## and may have these
+
+FAMILY = ("family", "start")
+    ## Family sections need these too
+
+FAMILIES = ("subsets", "nested")
+    ## The kinds of families
+
+
+def _dm_arguments():
+    """ Return the arguments dm_params can give, those of Exp.create_dm() 
+    and those of Exp.create_dm_param() (less names, the model's dm). """
+    
+    from simfMRI.expclass import Exp
+        ## Not at the top, as 
+        ## expclass imports plan
+
+    unit = inspect.getargspec(Exp.create_dm).args[1:]
+    param = [arg for arg in inspect.getargspec(Exp.create_dm_param).args[1:]
+            if arg != "names"]
+
+    return unit, param
+
+
+class ModelPlan():
+    """ The compiled models of <model_config> (an .ini file), in the
+    order Exp.run() fits them.
+
+    Each section becomes a model, a dict of its (REQUIRED and OPTIONAL)
+    options.  Options are parsed as python literals (not eval()ed) and
+    checked here, so a bad config fails before any simulations run. 
+    
+    A family_XX section instead declares a family of parametric models 
+    made from its dm names, either every (non-empty) subset of them 
+    (family = "subsets") or, in order, the first 1, 2, ... of them 
+    (family = "nested").  The members are named model_<start>, 
+    model_<start + 1>, and so on.  For example:
+
+        [family_01]
+        family = "nested"
+        start = 10
+        norm = "zscore"
+        bold = ["acc", ]
+        dm = ["value", "rpe", "rand"]
+        dm_params = {"drop":None, "box":True, "orth":False, "convolve":True}
+        bold_params = {"convolve":True}
+    
+    gives model_10 (value), model_11 (value, rpe) and model_12 (value, 
+    rpe, rand).  Members share one bold and are fit together, see
+    Exp._fit_family().  Each model of a family has its "family" and 
+    families (keyed by section) list their "members". """
+
+    def __init__(self, model_config):
+        self.model_config = model_config
+
+        conf = ConfigParser.RawConfigParser()
+        readresult = conf.read(model_config)
+            ## If conf.read() can't find model_config
+            ## it (annoyingly) returns an empty list
+        if not readresult:
+            raise IOError("No such file: '{0}'".format(model_config))
+
+        self.models = {}
+        self.families = {}
+        for sec in conf.sections():
+            if sec.startswith("family_"):
+                self.families[sec] = self._compile_family(
+                        sec, dict(conf.items(sec)))
+            else:
+                self._add(sec, self._compile(sec, dict(conf.items(sec))))
+        
+        for sec, family in sorted(self.families.items()):
+            for name, names in family["members"]:
+                model = dict(family, family=sec, dm=list(names))
+                del model["members"]
+                self._add(name, model)
+
+        self.names = sorted(self.models.keys())
+            ## Matches the (dir() based) order
+            ## models were once run in
+
+
+    def __contains__(self, name):
+        return name in self.models
+
+
+    def __iter__(self):
+        return ((name, self.models[name]) for name in self.names)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def _add(self, name, model):
+        """ Add <model> as <name>, which must be valid and unique. """
+
+        if not re.match("\Amodel_\d+\Z", name):
+            raise ValueError("{0} is not a valid model name.".format(name))
+        if name in self.models:
+            raise ValueError("{0} is not unique.".format(name))
+
+        self.models[name] = model
+
+
+    def _compile_family(self, name, options):
+        """ Parse and check the <options> (a dict of strings) of the
+        family <name>, and name its members. """
+
+        if not re.match("\Afamily_\d+\Z", name):
+            raise ValueError("{0} is not a valid family name.".format(name))
+
+        family = self._compile(name, options, FAMILY)
+        if family["family"] not in FAMILIES:
+            raise ValueError("{0}: family must be one of {1}.".format(
+                    name, FAMILIES))
+        if not (isinstance(family["start"], int) and family["start"] >= 0):
+            raise ValueError("{0}: start must be a whole number.".format(name))
+        if len(family["dm_params"]) != 4:
+            raise ValueError("{0}: families must be parametric.".format(name))
+        if family["dm_params"].get("orth"):
+            raise ValueError("{0}: families can't be orthgonalized.".format(
+                    name))
+        if len(family["dm"]) == 0:
+            raise ValueError("{0}: dm is empty.".format(name))
+
+        names = family["dm"]
+        if family["family"] == "subsets":
+            sets = [list(c) for n in range(1, len(names) + 1) 
+                    for c in itertools.combinations(names, n)]
+        else:
+            sets = [names[0:n] for n in range(1, len(names) + 1)]
+
+        family["members"] = [
+                ("model_{0:02d}".format(family["start"] + ii), names) 
+                for ii, names in enumerate(sets)]
+        
+        return family
+
+
+    def _compile(self, name, options, extra=()):
+        """ Parse and check the <options> (a dict of strings) of the
+        model <name>.  The <extra> options are required too. """
+
+        missing = [k for k in REQUIRED + extra if k not in options]
+        if missing:
+            raise ValueError("{0} is missing {1}.".format(name, missing))
+        unknown = [k for k in options if k not in REQUIRED + OPTIONAL + extra]
+        if unknown:
+            raise ValueError("{0} has unknown options {1}.".format(
+                    name, unknown))
+
+        model = {"stats":None}
+        for k, v in options.items():
+            try:
+                model[k] = ast.literal_eval(v)
+            except (ValueError, SyntaxError):
+                raise ValueError("{0}: {1} is not a literal ({2}).".format(
+                        name, k, v))
+
+        # Check the types,
+        if not ((model["norm"] is None) or isinstance(model["norm"], str)):
+            raise ValueError("{0}: norm must be a name or None.".format(name))
+        for k in ("bold", "dm"):
+            if not (isinstance(model[k], (list, tuple)) and
+                    all(isinstance(v, str) for v in model[k])):
+                raise ValueError("{0}: {1} must be a list of names.".format(
+                        name, k))
+            model[k] = list(model[k])
+        for k in ("dm_params", "bold_params"):
+            if not isinstance(model[k], dict):
+                raise ValueError("{0}: {1} must be a dict.".format(name, k))
+
+        # and the combinations.
+        unit, param = _dm_arguments()
+        if sorted(model["dm_params"]) not in (sorted(unit), sorted(param)):
+            raise ValueError("{0}: dm_params must give {1} (for create_dm)"
+                    " or {2} (for create_dm_param), not {3}.".format(
+                            name, unit, param, sorted(model["dm_params"])))
+        if len(model["dm_params"]) == 2:
+            absent = [b for b in model["bold"] if b not in model["dm"]]
+            if absent:
+                raise ValueError("{0}: bold {1} is not in dm.".format(
+                        name, absent))
+        elif len(model["bold"]) == 0:
+            raise ValueError("{0}: bold is empty.".format(name))
+
+        if model["stats"] is not None:
+            bad = [s for s in model["stats"] if s not in STATS]
+            if bad:
+                raise ValueError("{0}: unknown stats {1}.".format(name, bad))
+
+        return model
+
+
+    def doc(self, name):
+        """ Return a description of the model <name>. """
+
+        model = self.models[name]
+        dm = ["baseline", ] + model["dm"]
+            ## baseline is added automagically
+            ## during create_dm... so we add
+            ## it here too
+        if model["dm_params"].get("box"):
+            dm = ["baseline", "box"] + model["dm"]
+
+        return """ {0}. Bold: {1}. DM: {2}. """.format(name, model["bold"], dm)
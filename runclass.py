@@ -2,10 +2,35 @@
 import os
 from numpy.random import RandomState
 from multiprocessing import Pool
-from simfMRI.io import write_hdf, get_model_names
+from simfMRI.io import (write_hdf, get_model_names, create_writer, 
+        StreamWriter, CheckpointWriter)
 from simfMRI.analysis.plot import hist_t
-from simfMRI.mapreduce import create_chunks, reduce_chunks
-from simfMRI.misc import process_prng
+from simfMRI.mapreduce import (create_chunks, reduce_chunks, imap_window,
+        shard_indices, shard_from_env, shard_name)
+from simfMRI.misc import sim_prng
+from simfMRI.cache import LRUCache
+from simfMRI.online import Summary
+from simfMRI.plan import ModelPlan
+
+
+_worker = None
+    ## The Run a pool worker uses, 
+    ## set once by _init_worker()
+
+
+def _init_worker(run):
+    """ Give this (pool) worker its own copy of <run>, so the model plan
+    and caches are shipped (and kept) once, rather than with every task. """
+    
+    global _worker
+    _worker = run
+
+
+def _run_chunk(names):
+    """ Run the sims in <names> using this worker's Run. """
+
+    return _worker._singleloop(names)
+
 
 
 class Run():
@@ -30,78 +55,262 @@ class Run():
         # --
         # Optional Globals
         self.ncore = None
+        self.seed = 42
+            ## Sim k uses its own RandomState, made from 
+            ## seed and k (see simfMRI.misc.sim_prng), 
+            ## so results don't depend on ncore.
+        self.chunk_size = 1
+            ## Sims per parallel task.  Tasks are handed 
+            ## out as cores free up, so small tasks keep 
+            ## all cores busy.  None splits the run into 
+            ## ncore equal tasks.
+        self.dm_cache = LRUCache(maxsize=256)
+            ## Finished designs are shared between
+            ## simulations; set to None to disable.
+        self.save_fields = None
+            ## What each Exp saves, e.g. ("t", "beta") 
+            ## to keep only those stats (and metadata).
+            ## None saves everything.  See 
+            ## simfMRI.expclass.STATE_FIELDS and 
+            ## STAT_FIELDS for the options.
+        self.stream = None
+            ## If a name, go() streams results to 
+            ## <savedir>/<stream>.hdf5 as they arrive,
+        self.stream_size = 64
+            ## holding at most this many in memory 
+            ## while waiting to be written.
+        self.layout = "node"
+            ## The hdf5 layout of saved results, "node" 
+            ## or "columnar" (see simfMRI.io).
+        self.checkpoint = 100
+            ## If a number (and streaming), results are 
+            ## saved in parts of this many sims as they 
+            ## arrive, so a crashed run can be resumed 
+            ## (see simfMRI.io.CheckpointWriter).  None
+            ## streams straight to the file, which is
+            ## only readable once closed, so a crash 
+            ## loses every result.
+        self.resume = False
+            ## If True (and checkpointing), go() runs 
+            ## only the sims not yet checkpointed.
+        self.common_noise = False
+            ## If True, each sim draws its noise once 
+            ## and reuses it for every model (see 
+            ## simfMRI.expclass.Exp).
+        self.online = None
+            ## If a tuple of stats, e.g. ("t", "beta"), 
+            ## go() keeps only mergeable summaries of
+            ## them (see simfMRI.online.Summary) in the
+            ## summary attribute, not every result.
+        self.criteria = ()
+            ## Online summaries count the values 
+            ## above each of these.
     
         # ----
         # Misc
-        self.prngs = None   ## A list of RandomState() instances
-                            ## setup by the go() attr
+        self.summary = None ## A simfMRI.online.Summary, setup
+                            ## by go() if online is set
+        self.plan = None    ## The simfMRI.plan.ModelPlan() of
+                            ## model_conf, compiled by go()
     
     
-    def __call__(self, (names, prng)):
-        return self._singleloop((names, prng))
-
-
-    def _single(self, name, prng):
+    def _single(self, name):
         """ Using the BaseClass attribute run a simulation exp named
-        <name> using the given prng.  Returns a dictionary of results. """
+        <name> (an index) using its own prng (see the seed attribute).
+        Returns a dictionary of results. """
     
         print("Experiment {0}.".format(name))
         
+        prng = sim_prng(self.seed, name)
         exp = self.BaseClass(self.ntrial, TR=self.TR, ISI=self.ISI, prng=prng)
-        exp.populate_models(self.model_conf)
+        exp.dm_cache = self.dm_cache
+        exp.save_fields = self.save_fields
+        exp.common_noise = self.common_noise
+        if self.online is not None:
+            exp.save_fields = self.online
+                ## Summaries need nothing else
+        if self.plan is None:
+            self.plan = ModelPlan(self.model_conf)
+        exp.populate_models(self.plan)
 
         return exp.run(name)
 
 
-    def _singleloop(self, (names, prng)):
-        """ Loop over <names> and run an Exp for each.  Each Exp() uses
-        prng, a RandomState(). Returns a list of results dictionaries. """
+    def _singleloop(self, names):
+        """ Loop over <names> and run an Exp for each. Returns a list of 
+        results dictionaries. 
         
-        return [self._single(name, prng) for name in names]    
+        If the online attribute is set, the results are summarized as they
+        are made, and a list holding only that Summary is returned. """
+        
+        if self.online is None:
+            return [self._single(name) for name in names]    
+        
+        summary = Summary(self.online, criteria=self.criteria)
+        [summary.add(self._single(name)) for name in names]
+
+        return [summary, ]
             
             
+    def _savepath(self, name):
+        """ Return the path for <name> in savedir, creating savedir
+        if needed. """
+
+        try:
+            os.mkdir(self.savedir)
+        except OSError:
+            pass
+        
+        return os.path.join(self.savedir, name+".hdf5")
+
+
     def go(self, parallel=False):
         """ Run an experimental run, results are stored the 
-        results attribute. """
+        results attribute. 
+        
+        If the stream attribute is set, results are instead written to
+        <savedir>/<stream>.hdf5 as they arrive (by a writer thread, so 
+        compute and I/O overlap), and the results attribute is None. 
+        
+        If the online attribute is set, only summaries are kept.  They
+        are made by each worker, then merged into the summary attribute 
+        (see simfMRI.online.Summary), and the results attribute is None. 
+        
+        Streamed results are checkpointed as they arrive (unless the 
+        checkpoint attribute is None), and if resume is True only the sims 
+        missing from earlier checkpoints are run. """
+        
+        path = None
+        if (self.stream is not None) and (self.online is None):
+            path = self._savepath(self.stream)
+
+        self._go(range(self.nrun), path, parallel)
+
+
+    def go_shard(self, name, k=None, nshard=None, parallel=False):
+        """ Run only shard <k> of <nshard> (see 
+        simfMRI.mapreduce.shard_indices), streaming its results to
+        <savedir>/<name>_shard<k>of<nshard>.hdf5.  Returns that path.
         
+        Shards are independent and deterministic, so each can run on its
+        own node (e.g. of a batch scheduler's array job).  Give both <k> 
+        and <nshard>, or neither, in which case both are read from the 
+        environment (see simfMRI.mapreduce.shard_from_env). """
+
+        if self.online is not None:
+            raise ValueError("Shards are written to file, unset online.")
+
+        if (k is None) != (nshard is None):
+            raise ValueError("Give both k and nshard, or neither (to use"
+                    " the environment).")
+        if k is None:
+            k, nshard = shard_from_env()
+        
+        path = self._savepath(shard_name(name, k, nshard))
+        self._go(shard_indices(self.nrun, k, nshard), path, parallel)
+
+        return path
+
+
+    def _go(self, indices, path, parallel):
+        """ Run the sims in <indices>, streaming their results to <path> 
+        (if not None), see go(). """
+
+        # ----
+        # Compile the models, once,
+        self.plan = ModelPlan(self.model_conf)
+        print(self.plan.names)
+
+        # then setup the writer (if streaming) 
+        # and what's left to run.
+        indices = list(indices)
+        writer = None
+        if path is not None:
+            if self.checkpoint is None:
+                writer = create_writer(path, indices, self.layout)
+            else:
+                writer = CheckpointWriter(path, indices, self.layout, 
+                        self.checkpoint, self.resume)
+                indices = [ii for ii in indices if ii not in writer.written]
+                print("{0} simulations to run.".format(len(indices)))
+
+            writer = StreamWriter(writer, maxsize=self.stream_size)
+
+        pool = None
         if parallel:
             # ----
-            # Setup chunks and seeds
-            self.run_chunks = create_chunks(self.nrun, self.ncore)
-            self.prngs = [process_prng(ii+10) for ii in range(
-                    len(self.run_chunks))]
+            # Setup chunks
+            self.run_chunks = [[indices[ii] for ii in chunk] for chunk in
+                    create_chunks(len(indices), self.ncore, self.chunk_size)]
             
             # ----
-            # Create a pool, and use it,
-            # and store the results
-            pool = Pool(self.ncore)
-            results_in_chunks = pool.map(self, zip(self.run_chunks, self.prngs))
-                    ## Calling self here works via __call__
+            # Create a pool, and use it
+            pool = Pool(self.ncore, initializer=_init_worker, 
+                    initargs=(self, ))
+            results_in_chunks = imap_window(pool, _run_chunk, 
+                    self.run_chunks, 2 * self.ncore)
+                    ## Only a few chunks are in flight, 
+                    ## so finished results can't pile up
+                    ## waiting (e.g.) for the writer.
+                    ## They arrive as they finish, and are
+                    ## re-sorted (or written) by batch_code.
+        else:
+            # Run an experimental Run, one 
+            # sim at a time.
+            results_in_chunks = (self._singleloop([name, ]) 
+                    for name in indices)
+        
+        # ----
+        # Store (or stream) the results
+        # as they arrive.  If anything fails
+        # the pool is stopped and the writer
+        # closed (keeping any checkpoints).
+        try:
+            self._collect(results_in_chunks, writer)
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
 
-            self.results = reduce_chunks(results_in_chunks)
+    def _collect(self, results_in_chunks, writer):
+        """ Store the <results_in_chunks> (an iterable of results lists), 
+        in the results (or summary) attribute, or if <writer> is not None, 
+        by writing them. """
+
+        if self.online is not None:
+            self.summary = Summary(self.online, criteria=self.criteria)
+            for chunk in results_in_chunks:
+                [self.summary.merge(summary) for summary in chunk]
+                    ## Merged as they arrive, so only 
+                    ## one Summary is kept (per worker)
+            self.results = None
+        elif writer is None:
+            self.results = reduce_chunks(results_in_chunks, "batch_code")
         else:
-            # Run an experimental Run, and save to
-            # self.results
-            self.prngs = [process_prng(42), ]
-            
-            self.results = self._singleloop((range(self.nrun), self.prngs[0]))
-                    ## Calling self here works via __call__
+            try:
+                for chunk in results_in_chunks:
+                    for result in chunk:
+                        writer.put(result["batch_code"], result)
+            finally:
+                writer.close()
+
+            self.results = None
     
     
     def save_results(self, name):
         """ Save results as <name> in the dir specified in the 
         savedir attribute. """
 
-        # ----
-        # Create savedir if needed
-        try:
-            os.mkdir(self.savedir)
-        except OSError:
-            pass
+        if self.results is None:
+            print("Results were streamed or summarized, nothing to save.")
+            return
         
         print("Writing results to disk.")
-        savepath = os.path.join(self.savedir, name+".hdf5")
+        savepath = self._savepath(name)
         
-        write_hdf(self.results, savepath)
-
-        
\ No newline at end of file
+        write_hdf(self.results, savepath, self.layout)
@@ -0,0 +1,227 @@
+""" Regression tests for simfMRI.glm, checked against statsmodels and
+the code it replaced. """
+import unittest
+import itertools
+import numpy as np
+from simfMRI import glm
+try:
+    from statsmodels.api import GLS
+except ImportError:
+    try:
+        from scikits.statsmodels.api import GLS
+    except ImportError:
+        GLS = None
+
+
+def _design(prng, T=60, p=3):
+    """ A random (T x p) design, with the dummy (constant) on the right,
+    like those Exp.fit() makes. """
+
+    dm = np.ones((T, p + 1))
+    dm[:,0:p] = prng.normal(size=(T, p))
+
+    return dm
+
+
+@unittest.skipIf(GLS is None, "statsmodels is not installed")
+class TestFitBatch(unittest.TestCase):
+    """ fit_batch() and contrast() against statsmodels GLS (i.e. OLS). """
+
+    # The statsmodels name for each stat,
+    # as the old Exp._reformat_model() had it.
+    names = {
+        "beta":"params",
+        "t":"tvalues",
+        "fvalue":"fvalue",
+        "p":"pvalues",
+        "r":"rsquared",
+        "ci":"conf_int",
+        "resid":"resid",
+        "aic":"aic",
+        "bic":"bic",
+        "llf":"llf",
+        "mse_model":"mse_model",
+        "mse_resid":"mse_resid",
+        "mse_total":"mse_total"}
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+        self.dm = _design(self.prng)
+        self.bold = self.prng.normal(size=(5, self.dm.shape[0])) + np.dot(
+                self.prng.normal(size=(5, self.dm.shape[1])), self.dm.T)
+
+
+    def _check(self, results, ii, model):
+        for k, v in self.names.items():
+            expected = getattr(model, v)
+            if callable(expected):
+                expected = expected()
+            self.assertTrue(np.allclose(results[k][ii], expected), k)
+
+
+    def test_shared_design(self):
+        results = glm.fit_batch(self.bold, self.dm)
+        for ii, bold in enumerate(self.bold):
+            self._check(results, ii, GLS(bold, self.dm).fit())
+
+
+    def test_per_sim_designs(self):
+        dms = np.array([_design(self.prng) for bold in self.bold])
+        results = glm.fit_batch(self.bold, dms)
+        for ii, (bold, dm) in enumerate(zip(self.bold, dms)):
+            self._check(results, ii, GLS(bold, dm).fit())
+
+
+    def test_factorized_design(self):
+        design = glm.factorize(self.dm)
+        a = glm.fit_batch(self.bold, design)
+        b = glm.fit_batch(self.bold, self.dm)
+        for k in a:
+            self.assertTrue(np.allclose(a[k], b[k]), k)
+
+
+    def test_stats(self):
+        results = glm.fit_batch(self.bold, self.dm, stats=("t", ))
+        self.assertEqual(sorted(results.keys()),
+                ["df_resid", "scale", "t"])
+        self.assertRaises(ValueError, glm.fit_batch, self.bold, self.dm,
+                ("nope", ))
+
+
+    def test_contrast(self):
+        for bold in self.bold:
+            model = GLS(bold, self.dm).fit()
+            for con in ([1, -1, 0], [0, 1, -1, 0], [1, 0, 0]):
+                full = np.zeros(self.dm.shape[1])
+                full[0:len(con)] = con
+                expected = model.t_test(full)
+
+                df, t, p = glm.contrast(glm.fit(bold, self.dm), con)
+                self.assertTrue(np.allclose(df, expected.df_denom))
+                self.assertTrue(np.allclose(t, expected.tvalue))
+                self.assertTrue(np.allclose(p, expected.pvalue))
+
+
+def _old_orth(dm, nconds):
+    """ Exp._orth_dm() as it was, for a <dm> with a baseline and <nconds>
+    conditions, using least squares in place of GLS. """
+
+    ncols = dm.shape[1] - 1
+    orth_dm = np.zeros_like(dm)
+    orth_dm[:,0] = dm[:,0]
+    for cond in range(1, nconds + 1):
+        left = cond
+        right = cond + nconds
+        for cnt in range(ncols // nconds - 1):
+            x = dm[:,left].reshape(-1, 1)
+            beta = np.linalg.lstsq(x, dm[:,right], rcond=None)[0]
+            orth_dm[:,right] = dm[:,right] - np.dot(x, beta)
+            orth_dm[:,left] = dm[:,left]
+            left = right
+            right = right + nconds
+
+    return orth_dm
+
+
+def _pairs(dm, nconds):
+    """ The (left, right) pairs Exp._orth_dm() makes: the last col of each
+    condition and its left neighbor. """
+
+    last = (dm.shape[1] - 1) // nconds - 1
+
+    return [(cond + nconds * (last - 1), cond + nconds * last) 
+            for cond in range(1, nconds + 1)]
+
+
+class TestOrthogonalize(unittest.TestCase):
+    """ orthogonalize() against the old Exp._orth_dm() loop. """
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+
+
+    def test_two_columns(self):
+        # Two conditions, two columns each:
+        # results are unchanged
+        dm = self.prng.normal(size=(50, 5))
+        self.assertTrue(np.allclose(glm.orthogonalize(dm, _pairs(dm, 2)),
+                _old_orth(dm, 2)))
+
+
+    def test_three_columns(self):
+        # Three columns each: only the last
+        # is orthgonalized, as before.
+        dm = self.prng.normal(size=(50, 7))
+        self.assertTrue(np.allclose(glm.orthogonalize(dm, _pairs(dm, 2)),
+                _old_orth(dm, 2)))
+
+
+    def test_chain(self):
+        # Every right column of a chain is regressed 
+        # on the original left column.
+        dm = self.prng.normal(size=(50, 4))
+        orth = glm.orthogonalize(dm, [(1, 2), (2, 3)])
+        self.assertTrue(np.allclose((orth[:,1] * orth[:,2]).sum(), 0))
+        self.assertTrue(np.allclose((dm[:,2] * orth[:,3]).sum(), 0))
+
+
+    def test_stack(self):
+        dms = self.prng.normal(size=(3, 50, 5))
+        pairs = _pairs(dms[0], 2)
+        orth = glm.orthogonalize(dms, pairs)
+        for sim, dm in zip(orth, dms):
+            self.assertTrue(np.allclose(sim, glm.orthogonalize(dm, pairs)))
+
+
+    def test_zero_left(self):
+        dm = self.prng.normal(size=(50, 3))
+        dm[:,1] = 0
+        self.assertTrue(np.allclose(glm.orthogonalize(dm, [(1, 2)]), dm))
+        self.assertTrue(np.allclose(glm.orthogonalize(dm, []), dm))
+
+
+class TestUpdateDesigns(unittest.TestCase):
+    """ update_designs() against factorizing (and fitting) each design 
+    afresh. """
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+        self.dm = _design(self.prng, T=80, p=4)
+        self.bold = self.prng.normal(size=(3, 80))
+
+
+    def _check(self, dm, columns):
+        designs = list(glm.update_designs(dm, columns))
+        self.assertEqual(len(designs), len(columns))
+        for cols, design in zip(columns, designs):
+            fresh = glm.factorize(dm[:,cols])
+            for k in ("dm", "pinv", "cov", "rank", "const"):
+                self.assertTrue(np.allclose(design[k], fresh[k]), k)
+
+            a = glm.fit_batch(self.bold, design)
+            b = glm.fit_batch(self.bold, fresh)
+            for k in a:
+                self.assertTrue(np.allclose(a[k], b[k]), k)
+
+
+    def test_subsets(self):
+        p = self.dm.shape[1] - 1
+        columns = [list(c) + [p] for n in range(1, p + 1) 
+                for c in itertools.combinations(range(p), n)]
+        self._check(self.dm, columns)
+
+
+    def test_nested(self):
+        p = self.dm.shape[1] - 1
+        self._check(self.dm, [range(n) + [p] for n in range(1, p + 1)])
+        self._check(self.dm, [range(n) + [p] for n in range(p, 0, -1)])
+
+
+    def test_rank_deficient(self):
+        dm = self.dm.copy()
+        dm[:,2] = dm[:,0] * 2
+        self._check(dm, [[0, 1, 4], [0, 1, 2, 4], [1, 2, 3, 4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+""" Regression tests for simfMRI.hrf. """
+import unittest
+import numpy as np
+from simfMRI import hrf
+
+
+def _reference(arr, h):
+    """ Convolve each column of the 2d <arr> with <h> using np.convolve,
+    truncating to the length of <arr> (as Exp._convolve_hrf() once did). """
+
+    return np.column_stack(
+            [np.convolve(col, h)[0:arr.shape[0]] for col in arr.T])
+
+
+class TestConvolve(unittest.TestCase):
+    """ convolve() against np.convolve, column by column. """
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+        self.hrf = hrf.double_gamma(20, 1)
+
+
+    def test_direct(self):
+        arr = self.prng.normal(size=(100, 4))
+        self.assertTrue(np.allclose(hrf.convolve(arr, self.hrf),
+                _reference(arr, self.hrf)))
+
+
+    def test_fft(self):
+        arr = self.prng.normal(size=(hrf._DIRECT_MAX + 50, 4))
+        self.assertTrue(np.allclose(hrf.convolve(arr, self.hrf),
+                _reference(arr, self.hrf)))
+
+
+    def test_shapes(self):
+        arr = self.prng.normal(size=(3, 80, 2))
+        conv = hrf.convolve(arr, self.hrf)
+        self.assertEqual(conv.shape, arr.shape)
+        for sim, expected in zip(conv, arr):
+            self.assertTrue(np.allclose(sim, _reference(expected, self.hrf)))
+
+        col = arr[0,:,0]
+        self.assertTrue(np.allclose(hrf.convolve(col, self.hrf),
+                np.convolve(col, self.hrf)[0:col.shape[0]]))
+
+
+    def test_short_array(self):
+        arr = self.prng.normal(size=(5, 2))
+        self.assertTrue(np.allclose(hrf.convolve(arr, self.hrf),
+                _reference(arr, self.hrf)))
+
+
+if __name__ == "__main__":
+    unittest.main()
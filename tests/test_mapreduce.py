@@ -0,0 +1,79 @@
+""" Regression tests for simfMRI.mapreduce. """
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from simfMRI import io
+from simfMRI.mapreduce import merge_shards, shard_indices, shard_name
+
+
+def _result(prng, index):
+    """ A small results dict for the sim <index>, like those Exp.run()
+    makes. """
+
+    return {
+        "batch_code":index,
+        "TR":2,
+        "ISI":2,
+        "model_01":{
+            "t":prng.normal(size=3),
+            "beta":prng.normal(size=3),
+            "aic":prng.normal(),
+            "data":{"meta":{"dm":["a", "b"], "bold":["acc", ]}}}}
+
+
+class TestMergeShards(unittest.TestCase):
+    """ merge_shards() against the results written to the shards. """
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+        self.dir = tempfile.mkdtemp()
+        self.nrun = 3
+        self.results = [_result(self.prng, ii) for ii in range(self.nrun)]
+
+
+    def tearDown(self):
+        io.close_readers()
+        shutil.rmtree(self.dir)
+
+
+    def _merge(self, layout, nshard, order):
+        paths = []
+        for k in order:
+            path = os.path.join(self.dir, shard_name("s", k, nshard) + ".hdf5")
+            indices = shard_indices(self.nrun, k, nshard)
+            writer = io.create_writer(path, indices, layout)
+            [writer.write(ii, self.results[ii]) for ii in indices]
+            writer.close()
+            paths.append(path)
+
+        name = os.path.join(self.dir, "merged.hdf5")
+        merge_shards(paths, name)
+
+        return name
+
+
+    def _check(self, name):
+        for stat in ("t", "beta", "aic"):
+            self.assertTrue(np.allclose(
+                    io.read_hdf(name, "/model_01/" + stat),
+                    [result["model_01"][stat] for result in self.results]))
+
+
+    def test_columnar(self):
+        self._check(self._merge("columnar", 3, [2, 0, 1]))
+
+
+    def test_empty_shard(self):
+        # With 3 sims in 4 shards, one is
+        # empty, wherever it is listed.
+        for order in ([0, 1, 2, 3], [3, 0, 1, 2], [1, 3, 2, 0]):
+            self._check(self._merge("columnar", 4, order))
+            io.close_readers()
+
+        self._check(self._merge("node", 4, [3, 0, 1, 2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
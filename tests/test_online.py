@@ -0,0 +1,44 @@
+""" Regression tests for simfMRI.online. """
+import unittest
+import numpy as np
+from simfMRI.online import Accumulator, Summary
+
+
+class TestAccumulator(unittest.TestCase):
+    """ Accumulator against numpy, on the whole of the data. """
+
+    def setUp(self):
+        self.prng = np.random.RandomState(42)
+        self.x = self.prng.normal(3, 1, size=(40, 2))
+
+
+    def test_quantile(self):
+        acc = Accumulator(["a", "b"], width=0.01)
+        acc.add(self.x)
+        for q in (0, 0.1, 0.5, 0.9, 1):
+            self.assertTrue(np.all(np.abs(acc.quantile(q) -
+                    np.percentile(self.x, q * 100, axis=0)) <= 0.005 + 1e-9))
+
+
+    def test_merge(self):
+        a = Accumulator(["a", "b"])
+        a.add(self.x)
+        b = Accumulator(["a", "b"])
+        b.add(self.x[0:15])
+        c = Accumulator(["a", "b"])
+        c.add(self.x[15:])
+        b.merge(c)
+        self.assertEqual(a.counts, b.counts)
+        self.assertTrue(np.allclose(a.mean, b.mean))
+        self.assertTrue(np.allclose(a.m2, b.m2))
+
+
+class TestSummary(unittest.TestCase):
+
+    def test_stats(self):
+        self.assertRaises(ValueError, Summary, ("t", "ci"))
+        self.assertRaises(ValueError, Summary, ("resid", ))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+""" Regression tests for simfMRI.plan, and how Exp uses it. """
+import os
+import shutil
+import tempfile
+import unittest
+from simfMRI.exp_examples import Simple
+from simfMRI.plan import ModelPlan
+
+
+MODEL = """
+[model_01]
+norm = "zscore"
+bold = ["box", ]
+dm = ["box", ]
+dm_params = {0}
+bold_params = {{"convolve" : False}}
+"""
+
+
+class SimpleMethod(Simple):
+    """ Simple, with a model of its own. """
+
+    def model_09(self):
+        """ Fit model_01 again. """
+
+        self.model_01()
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def _plan(self, dm_params):
+        path = os.path.join(self.dir, "models.ini")
+        with open(path, "w") as f:
+            f.write(MODEL.format(dm_params))
+
+        return ModelPlan(path)
+
+
+    def test_dm_params(self):
+        self._plan('{"drop" : None, "convolve" : True}')
+        self._plan('{"drop" : None, "box" : True, "orth" : False,'
+                ' "convolve" : True}')
+        for bad in ('{"drop" : None, "box" : True}',
+                '{"drop" : None, "bx" : True, "orth" : False,'
+                ' "convolve" : True}',
+                '{"drop" : None}'):
+            self.assertRaises(ValueError, self._plan, bad)
+
+
+    def test_model_names(self):
+        # Methods run alongside the plan,
+        exp = SimpleMethod(10, prng=1)
+        exp.populate_models(self._plan('{"drop" : None, "convolve" : True}'))
+        self.assertEqual(exp._model_names(), ["model_01", "model_09"])
+        self.assertEqual(sorted(exp.run(0).keys()),
+                ["batch_code", "model_01", "model_09"])
+
+        # but can't share a name with it.
+        SimpleMethod.model_01 = SimpleMethod.model_09
+        try:
+            self.assertRaises(ValueError, exp._model_names)
+        finally:
+            del SimpleMethod.model_01
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+""" Regression tests for simfMRI.runclass. """
+import os
+import unittest
+import numpy as np
+from simfMRI.exp_examples import Simple
+from simfMRI.runclass import Run
+
+
+class RunSimple(Run):
+    """ A small Run of the Simple example. """
+
+    def __init__(self):
+        Run.__init__(self)
+
+        self.BaseClass = Simple
+        self.nrun = 6
+        self.TR = 2
+        self.ISI = 2
+        self.model_conf = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "..", "bin", "simple.ini")
+        self.savedir = None
+        self.ntrial = 20
+        self.ncore = 2
+
+
+class TestReproducible(unittest.TestCase):
+    """ Each sim has its own prng (see simfMRI.misc.sim_prng), so results
+    must not depend on how (or whether) the run is split across cores. """
+
+    stats = ("t", "beta", "bold", "dm")
+
+    def setUp(self):
+        self.serial = RunSimple()
+        self.serial.go(parallel=False)
+
+
+    def _check(self, results):
+        self.assertEqual(len(results), len(self.serial.results))
+        for a, b in zip(self.serial.results, results):
+            self.assertEqual(a["batch_code"], b["batch_code"])
+            for model in ("model_01", "model_02"):
+                for stat in self.stats:
+                    self.assertTrue(np.array_equal(
+                            a[model][stat], b[model][stat]), stat)
+
+
+    def test_parallel(self):
+        for chunk_size in (1, 4, None):
+            run = RunSimple()
+            run.chunk_size = chunk_size
+            run.go(parallel=True)
+            self._check(run.results)
+
+
+    def test_cores(self):
+        run = RunSimple()
+        run.ncore = 3
+        run.go(parallel=True)
+        self._check(run.results)
+
+
+    def test_seed(self):
+        run = RunSimple()
+        run.seed = 7
+        run.go(parallel=False)
+        self.assertFalse(np.array_equal(run.results[0]["model_01"]["bold"],
+                self.serial.results[0]["model_01"]["bold"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
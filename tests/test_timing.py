@@ -0,0 +1,112 @@
+""" Regression tests for simfMRI.timing, against the loop based code it
+replaced. """
+import unittest
+import numpy as np
+from simfMRI import timing
+
+
+def _old_dtime(trials, durations, drop=None, drop_value=0):
+    """ dtime(), as it was. """
+
+    dtrials = []
+    if drop == None:
+        [dtrials.extend([trial, ] * dur) for trial, dur in zip(
+            trials, durations)]
+    else:
+        mask = np.array(drop) == 1
+        for trial, dur in zip(trials, durations):
+            dtrial = np.array([trial, ] * dur)
+            short = np.zeros(dur, dtype=bool)
+            short[0:mask[0:dur].shape[0]] = mask[0:dur]
+                ## Old numpy treated a short mask as 
+                ## padded with False; new numpy raises
+            dtrial[short] = drop_value
+            dtrials.extend(dtrial.tolist())
+
+    return np.array(dtrials)
+
+
+def _old_unit(trials, durations, drop=None):
+    """ Exp.create_dm(), as it was (without convolution). """
+
+    trials = np.asarray(trials)
+    cond_levels = sorted(list(set(trials)))
+
+    dm_unit = np.zeros((np.sum(durations), len(cond_levels)))
+    for col, cond in enumerate(cond_levels):
+        mask_in_tr = _old_dtime(trials == cond, durations, drop, False)
+        dm_unit[mask_in_tr,col] = 1
+
+    return dm_unit
+
+
+def _old_param(trials, durations, data, names, drop=None, box=True):
+    """ Exp.create_dm_param(), as it was (without orthgonalization or
+    convolution). """
+
+    trials = np.asarray(trials)
+    cond_levels = sorted(list(set(trials)))
+
+    dm_param = []
+    for cond in cond_levels:
+        if cond == 0:
+            continue
+        dm_temp = np.zeros((np.sum(durations), len(names)))
+        mask_in_tr = _old_dtime(trials == cond, durations, drop, False)
+        for col, name in enumerate(names):
+            data_in_tr = _old_dtime(data[name], durations, drop, 0)
+            dm_temp[mask_in_tr,col] = data_in_tr[mask_in_tr]
+        dm_param.append(dm_temp)
+    dm_param = np.hstack(dm_param)
+
+    dm_unit = _old_unit(trials, durations)
+    if box:
+        return np.hstack((dm_unit, dm_param))
+
+    return np.hstack((dm_unit[:,0:1], dm_param))
+
+
+class TestTiming(unittest.TestCase):
+    """ dtime() and design() against their old versions. """
+
+    drops = (None, [0, 1, 0], [1, ], [0, 0, 1, 1, 1])
+
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.trials = prng.randint(0, 3, 40)
+        self.durations = prng.randint(1, 5, 40)
+        self.data = {
+                "value":prng.normal(size=40).tolist(),
+                "rpe":prng.normal(size=40).tolist()}
+
+
+    def test_dtime(self):
+        for drop in self.drops:
+            self.assertTrue(np.array_equal(
+                    timing.dtime(self.trials, self.durations, drop),
+                    _old_dtime(self.trials, self.durations, drop)))
+            self.assertTrue(np.allclose(
+                    timing.dtime(self.data["value"], self.durations, drop),
+                    _old_dtime(self.data["value"], self.durations, drop)))
+
+
+    def test_unit_design(self):
+        for drop in self.drops:
+            self.assertTrue(np.array_equal(
+                    timing.design(self.trials, self.durations, drop=drop),
+                    _old_unit(self.trials, self.durations, drop)))
+
+
+    def test_param_design(self):
+        for drop in self.drops:
+            for box in (True, False):
+                for names in (["value", ], ["value", "rpe"]):
+                    self.assertTrue(np.allclose(
+                            timing.design(self.trials, self.durations,
+                                    self.data, names, drop, box),
+                            _old_param(self.trials, self.durations,
+                                    self.data, names, drop, box)))
+
+
+if __name__ == "__main__":
+    unittest.main()
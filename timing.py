@@ -2,6 +2,29 @@
 import numpy as np
 
 
+def _dropped(durations, drop):
+    """ Return a bool mask, in TR time, that is True wherever <drop> (see 
+    dtime()) removes an entry from a trial of the given <durations>. """
+
+    durations = np.asarray(durations, dtype=int)
+    dropped = np.zeros(durations.sum(), dtype=bool)
+    if drop is None:
+        return dropped
+
+    drop = np.array(drop) == 1
+        ## Convert drop to a bool mask
+
+    # Find the offset of each TR into its trial,
+    # then drop by looking each offset up in drop.
+    # Offsets past the end of drop are kept.
+    starts = np.cumsum(durations) - durations
+    offset = np.arange(durations.sum()) - np.repeat(starts, durations)
+    inside = offset < drop.shape[0]
+    dropped[inside] = drop[offset[inside]]
+
+    return dropped
+
+
 def dtime(arr, durations, drop=None, drop_value=0):
     """ Repeat each element or row in <arr> by the factor
     specified in durations.
@@ -25,30 +48,79 @@ def dtime(arr, durations, drop=None, drop_value=0):
     Note: If duration for that trial is less than the length
     of drop, the rightside excess entries of drop are ignored.
 
-    Returns a list of the duration mapped trials. """
+    Returns an array of the duration mapped trials. """
     
-    trials = arr
-    dtrials = []
-
-    if drop == None:
-        # Using tuple math, repeat trial by dur
-        # adding flattly to dtrials.
-        [dtrials.extend([trial, ] * dur) for trial, dur in zip(
-            trials, durations)]
-    else:
-        # As above but dropping trial entries       
-        mask = np.array(drop) == 1
-            ## Convert drop to a bool mask
+    arr = np.asarray(arr)
+    durations = np.asarray(durations, dtype=int)
+    
+    n = min(arr.shape[0], durations.shape[0])
+    arr, durations = arr[0:n], durations[0:n]
+        ## Like zip(), ignore any unmatched excess
+
+    dtrials = np.repeat(arr, durations, axis=0)
+    if drop is not None:
+        dtrials[_dropped(durations, drop)] = drop_value
+
+    return dtrials
+
+
+def design(trials, durations, data=None, names=None, drop=None, box=True):
+    """ Build an (unconvolved) design matrix, in TR time, in a single pass.
+
+    If <names> is None this is a unit (boxcar-only) DM with one column 
+    for each (sorted) condition in <trials>.  Entries removed by <drop> 
+    (see dtime()) are 0.
+
+    Otherwise it is a parametric DM.  For each non-zero condition there is 
+    a block of columns, one for each of <names> in <data>, holding that 
+    data wherever the condition is on (and not dropped).  On the left of the 
+    blocks is either the full (undropped) unit DM, if <box>, or just its 
+    baseline column. """
+
+    trials = np.asarray(trials)
+    durations = np.asarray(durations, dtype=int)
+    n = min(trials.shape[0], durations.shape[0])
+    trials, durations = trials[0:n], durations[0:n]
+
+    levels = np.unique(trials)
+        ## Sorted conditions
+
+    # The condition (as an index into levels)
+    # and row for each TR.
+    level_tr = np.repeat(np.searchsorted(levels, trials), durations)
+    rows = np.arange(level_tr.shape[0])
+    keep = ~_dropped(durations, drop)
     
-        for trial, dur in zip(trials, durations):
-            dtrial = np.array([trial, ] * dur)
-            dtrial[mask[0:dur]] = drop_value
-                ## Apply mask
-                ## drop rightside excess entries in drop as dur 
+    if names is None:
+        dm_unit = np.zeros((rows.shape[0], levels.shape[0]))
+        dm_unit[rows[keep], level_tr[keep]] = 1
 
-            dtrials.extend(dtrial.tolist())
+        return dm_unit
+
+    # Allocate the whole parametric DM up front...
+    is_param = levels != 0
+    num_names = len(names)
+    num_unit = levels.shape[0] if box else 1
+    dm = np.zeros((rows.shape[0], num_unit + is_param.sum() * num_names))
+    
+    # add the unit DM (or its baseline),
+    if box:
+        dm[rows, level_tr] = 1
+    else:
+        dm[:,0] = level_tr == 0
+
+    # then fill every condition"s block of 
+    # named data at once.
+    values = np.column_stack(
+            [np.asarray(data[name], dtype=float)[0:n] for name in names])
+    values_tr = np.repeat(values, durations, axis=0)
+    
+    on = keep & is_param[level_tr]
+    block = (np.cumsum(is_param) - 1)[level_tr[on]]
+    cols = num_unit + (block * num_names).reshape(-1, 1) + np.arange(num_names)
+    dm[rows[on].reshape(-1, 1), cols] = values_tr[on]
 
-    return np.array(dtrials)
+    return dm
 
 
 def add_empty(data, conditions):